@@ -1,12 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, Response, send_file, session, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
 import os
 import logging
-from datetime import datetime
+import click
+import json
+import mimetypes
+import re
+from datetime import datetime, timedelta
 from config import config
+from view_counter import ViewCounter
+from trending import TrendingEngine
+from cache import TTLCache
+from pagination import decode_cursor, encode_cursor, keyset_paginate
+from timeline import create_timeline_store
+from search_index import create_search_index
+from autocomplete import PrefixIndex
+from background import PeriodicTask
+from notifications import NotificationDispatcher
+from live import create_event_broker, make_event
+from imaging import MediaProcessor, SIZES, VARIANT_DIR
+from video import process_video
+from media_store import MediaStore, blob_digest
+from uploads import ChunkedUploadStore, UploadError, TUS_VERSION, CHECKSUM_ALGORITHMS, parse_metadata, parse_checksum
+from query_budget import QueryBudget
+from index_advisor import IndexAdvisor
+from database import ReplicaRouter, RoutingSession, WriteQueue, apply_sqlite_profile, engine_options, insert_ignore, pool_stats, sqlite_pragmas
 
 # Setup logging
 def setup_logging():
@@ -32,6 +55,10 @@ def create_app(config_name=None):
         config_name = os.environ.get('FLASK_ENV', 'development')
     
     app.config.from_object(config[config_name])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **engine_options(app.config),
+        **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
     
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -66,15 +93,37 @@ def internal_error(error):
 
 @app.errorhandler(413)
 def too_large(error):
+    if request.path.startswith('/uploads'):
+        # tus clients need a plain 413; chunks are capped by MAX_CONTENT_LENGTH
+        return handle_upload_error(UploadError('Chunk is larger than the server accepts, send smaller chunks', 413))
     flash('File too large. Maximum size is 16MB.')
     return redirect(request.url)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+with app.app_context():
+    for engine in db.engines.values():
+        apply_sqlite_profile(engine, sqlite_pragmas(app.config))
+write_queue = WriteQueue(app, db)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
+view_counter = ViewCounter(app, db)
+# Shared feed pages, see cached_feed
+page_cache = TTLCache(
+    max_entries=app.config.get('PAGE_CACHE_SIZE', 2000),
+    ttl=app.config.get('PAGE_CACHE_TTL', 30),
+    max_bytes=app.config.get('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+)
+query_budget = QueryBudget(app)
+
+def partial_index(name, *columns, where):
+    """Index over only the rows matching `where` (SQLite and Postgres)"""
+    condition = db.text(where)
+    return db.Index(name, *columns, sqlite_where=condition, postgresql_where=condition)
 
 # Database Models
+# Indexes are declared here for db.create_all() and created on existing
+# databases by migrate_db.py, under the same names.
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -84,6 +133,7 @@ class User(UserMixin, db.Model):
     bio = db.Column(db.Text)
     tos_accepted = db.Column(db.Boolean, default=False)  # Terms of Service acceptance
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_notification_count = db.Column(db.Integer, default=0, nullable=False)  # Maintained by the notification dispatcher and mark-read routes
     
     # Following system - simplified relationship
     following = db.relationship(
@@ -93,6 +143,11 @@ class User(UserMixin, db.Model):
         backref=db.backref('followers', lazy='dynamic'),
         lazy='dynamic'
     )
+    
+    __table_args__ = (
+        # LIKE 'abc%' can only use a plain index under the C collation on Postgres
+        db.Index('idx_user_username_prefix', 'username', postgresql_ops={'username': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -104,11 +159,39 @@ class Post(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     view_count = db.Column(db.Integer, default=0)  # Track post views
+    like_count = db.Column(db.Integer, default=0, nullable=False)  # Denormalized, see adjust_post_counter
+    comment_count = db.Column(db.Integer, default=0, nullable=False)  # Denormalized, see adjust_post_counter
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    variants = db.Column(db.JSON(none_as_null=True))  # Derivative paths by name ('thumb', 'feed_webp', 'poster', ...), see imaging.py
+    duration = db.Column(db.Float)  # Videos, in seconds (see video.py)
+    video_codec = db.Column(db.String(20))
     
     # Relationships
     author = db.relationship('User', backref='user_posts')
     likes = db.relationship('Like', backref='post', lazy=True)
     comments = db.relationship('Comment', backref='post', lazy=True)
+    
+    # Keyset pagination indexes (see pagination.py and migrate_db.py)
+    __table_args__ = (
+        db.Index('idx_post_created_id', 'created_at', 'id'),
+        db.Index('idx_post_user_created_id', 'user_id', 'created_at', 'id'),
+        db.Index('idx_post_media_path', 'media_path'),
+        partial_index('idx_post_trending', 'created_at', 'like_count', where='like_count > 0'),
+        partial_index('idx_post_unprocessed', 'id', where='variants IS NULL'),
+    )
+
+class MediaBlob(db.Model):
+    """A stored media file, shared by every post with the same content (see media_store.py)"""
+    path = db.Column(db.String(200), primary_key=True)  # ab/cd/<sha256>.<ext>
+    size = db.Column(db.BigInteger)
+    ref_count = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ReplicaHeartbeat(db.Model):
+    """One row the workers keep touching on the primary, read back to measure replica lag"""
+    id = db.Column(db.Integer, primary_key=True)
+    written_at = db.Column(db.DateTime, nullable=False)
 
 class Like(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -118,6 +201,13 @@ class Like(db.Model):
     
     # Relationships
     user = db.relationship('User', backref='user_likes')
+    
+    # One like per user and post; also serves "which of these posts did I like".
+    # post_id is the trending aggregate's join key.
+    __table_args__ = (
+        db.Index('uq_like_user_post', 'user_id', 'post_id', unique=True),
+        db.Index('idx_like_post_id', 'post_id'),
+    )
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -130,6 +220,11 @@ class Comment(db.Model):
     
     # Relationships
     author = db.relationship('User', backref='user_comments')
+    
+    __table_args__ = (
+        db.Index('idx_comment_post_id', 'post_id'),
+        db.Index('idx_comment_user_id', 'user_id'),
+    )
 
 class Notification(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -143,6 +238,13 @@ class Notification(db.Model):
     
     # Relationships
     user = db.relationship('User', backref=db.backref('notifications', lazy='dynamic'))
+    
+    __table_args__ = (
+        db.Index('idx_notification_user_id', 'user_id'),
+        db.Index('idx_notification_is_read', 'is_read'),
+        db.Index('idx_notification_user_read_created', 'user_id', 'is_read', 'created_at'),
+        partial_index('idx_notification_unread', 'user_id', 'created_at', where='NOT is_read'),
+    )
 
 class SupportTicket(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -158,6 +260,11 @@ class SupportTicket(db.Model):
     
     # Relationships
     user = db.relationship('User', backref=db.backref('support_tickets', lazy='dynamic'))
+    
+    __table_args__ = (
+        db.Index('idx_support_ticket_user_id', 'user_id'),
+        db.Index('idx_support_ticket_status', 'status'),
+    )
 
 class Report(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -175,11 +282,20 @@ class Report(db.Model):
     # Relationships
     reporter = db.relationship('User', foreign_keys=[reporter_id], backref='reports_filed')
     reviewer = db.relationship('User', foreign_keys=[reviewed_by], backref='reports_reviewed')
+    
+    __table_args__ = (
+        db.Index('idx_report_reporter_id', 'reporter_id'),
+        db.Index('idx_report_status', 'status'),
+        db.Index('idx_report_type_id', 'reported_type', 'reported_id'),
+        partial_index('idx_report_pending', 'created_at', where="status = 'pending'"),
+    )
 
 # Followers association table
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('idx_followers_follower', 'follower_id'),
+    db.Index('idx_followers_followed', 'followed_id')
 )
 
 # Hashtag model
@@ -191,11 +307,20 @@ class Hashtag(db.Model):
     
     # Relationships
     posts = db.relationship('Post', secondary='post_hashtags', backref='hashtags')
+    
+    __table_args__ = (
+        db.Index('idx_hashtag_name', 'name'),
+        db.Index('idx_hashtag_post_count', 'post_count'),
+        db.Index('idx_hashtag_name_prefix', 'name', postgresql_ops={'name': 'text_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
 
 # Post-Hashtag association table
 post_hashtags = db.Table('post_hashtags',
     db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
-    db.Column('hashtag_id', db.Integer, db.ForeignKey('hashtag.id'), primary_key=True)
+    db.Column('hashtag_id', db.Integer, db.ForeignKey('hashtag.id'), primary_key=True),
+    db.Index('idx_post_hashtags_post', 'post_id'),
+    db.Index('idx_post_hashtags_hashtag', 'hashtag_id'),
+    db.Index('idx_post_hashtags_hashtag_post', 'hashtag_id', 'post_id')
 )
 
 # Mention model
@@ -210,23 +335,180 @@ class Mention(db.Model):
     post = db.relationship('Post', backref='mentions')
     comment = db.relationship('Comment', backref='mentions')
     mentioned_user = db.relationship('User', backref='mentioned_in')
+    
+    __table_args__ = (
+        db.Index('idx_mention_post_id', 'post_id'),
+        db.Index('idx_mention_user_id', 'mentioned_user_id'),
+    )
+
+# GET requests read from REPLICA_DATABASE_URL while it keeps up (see database.py)
+replica_router = ReplicaRouter(app, db, ReplicaHeartbeat.__table__)
+
+# Materialized following-feed timelines (see timeline.py)
+timeline_store = create_timeline_store(app, db)
+
+# Full-text search index (see search_index.py), None if the database has no support
+search_index = create_search_index(db, app.config['SQLALCHEMY_DATABASE_URI'])
+
+@db.event.listens_for(Post, 'after_delete')
+def remove_post_from_search_index(mapper, connection, post):
+    """Keep the search index in sync when posts are deleted"""
+    if search_index is not None:
+        search_index.remove_post(post.id, connection)
+
+# Content-addressed uploads (see media_store.py); unreferenced blobs are removed by `flask media-gc`
+media_store = MediaStore(app.config['UPLOAD_FOLDER'])
+
+def acquire_blob(path, size, connection=None):
+    """Count one more post using a stored file (part of the caller's transaction)"""
+    blobs = MediaBlob.__table__
+    executor = connection if connection is not None else db.session
+    insert_ignore(blobs, [{'path': path, 'size': size, 'ref_count': 0, 'created_at': datetime.utcnow()}], executor)
+    executor.execute(blobs.update().where(blobs.c.path == path).values(ref_count=blobs.c.ref_count + 1))
+
+def release_blob(connection, path):
+    blobs = MediaBlob.__table__
+    connection.execute(blobs.update().where(blobs.c.path == path).values(ref_count=blobs.c.ref_count - 1))
+
+@db.event.listens_for(Post, 'after_delete')
+def release_deleted_post_blob(mapper, connection, post):
+    release_blob(connection, post.media_path)
+
+# Autocomplete prefix indexes (see autocomplete.py), loaded per worker in the background
+user_index = PrefixIndex()
+hashtag_index = PrefixIndex()
+
+def load_autocomplete_indexes():
+    """(Re)load usernames ranked by follower count and hashtags ranked by post count"""
+    with app.app_context():
+        follower_counts = dict(
+            db.session.query(followers.c.followed_id, db.func.count()).group_by(followers.c.followed_id)
+        )
+        user_index.load(
+            (username, follower_counts.get(user_id, 0))
+            for user_id, username in db.session.query(User.id, User.username)
+        )
+        hashtag_index.load(db.session.query(Hashtag.name, Hashtag.post_count))
+
+autocomplete_refresh = PeriodicTask(
+    'autocomplete-refresh',
+    app.config.get('AUTOCOMPLETE_REFRESH_INTERVAL', 600),
+    load_autocomplete_indexes,
+    run_immediately=True
+)
+
+def suggest(index, model, column, prefix, limit=10):
+    """(name, score) suggestions from a prefix index, or a database prefix query while it loads"""
+    autocomplete_refresh.ensure_started()
+    if index.loaded:
+        return index.search(prefix, limit)
+    if not prefix:
+        return []
+    score = Hashtag.post_count if model is Hashtag else db.literal(0)
+    return db.session.query(column, score).filter(column.startswith(prefix, autoescape=True)).limit(limit).all()
+
+# Notifications are written in batches off the request path (see notifications.py)
+notification_dispatcher = NotificationDispatcher(app, db, Notification.__table__)
+
+@notification_dispatcher.on_written
+def increment_unread_counts(connection, rows):
+    """Bump each recipient's unread counter in the same transaction as the insert"""
+    counts = {}
+    for row in rows:
+        counts[row['user_id']] = counts.get(row['user_id'], 0) + 1
+    users = User.__table__
+    connection.execute(
+        users.update().where(users.c.id == db.bindparam('recipient_id')).values(
+            unread_notification_count=db.func.coalesce(users.c.unread_notification_count, 0) + db.bindparam('unread')
+        ),
+        [{'recipient_id': user_id, 'unread': count} for user_id, count in counts.items()]
+    )
+
+event_broker = create_event_broker(app)
+
+image_processor = MediaProcessor(app, db, Post.__table__)
+video_processor = MediaProcessor(app, db, Post.__table__, job=process_video, workers_setting='VIDEO_WORKERS')
+
+@image_processor.on_media_moved
+def move_blob_reference(connection, old_path, new_path):
+    """A post now uses its metadata-free original; move its reference over"""
+    acquire_blob(new_path, os.path.getsize(media_store.path(new_path)), connection)
+    release_blob(connection, old_path)
+
+chunked_uploads = ChunkedUploadStore(app.config['CHUNKED_UPLOAD_FOLDER'], app.config['CHUNKED_UPLOAD_EXPIRY'])
+upload_cleanup = PeriodicTask('partial-upload-cleanup', 3600, chunked_uploads.cleanup, run_immediately=True)
+
+@app.template_global()
+def media_url(post, variant=None):
+    """URL of a post's media, or of one of its image variants once generated"""
+    path = post.media_path
+    if variant and post.variants and variant in post.variants:
+        path = post.variants[variant]
+    return url_for('media', path=path)
+
+FINGERPRINT = re.compile(r'^[0-9a-f]{64}')
+
+def media_etag(path, full_path):
+    """(etag, immutable) for a stored file; blobs and their variants are named by content hash"""
+    stem = path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+    if blob_digest(path) or (path.startswith(VARIANT_DIR + '/') and FINGERPRINT.match(stem)):
+        return stem, True
+    # Legacy uploads: modification time and size, so no request has to read the whole file
+    stat = os.stat(full_path)
+    return f'{stat.st_mtime_ns:x}-{stat.st_size:x}', False
+
+@app.route('/media/<path:path>')
+def media(path):
+    """Uploaded files and their variants, with Range (206), strong ETags and far-future caching.
+    
+    With MEDIA_ACCEL=nginx the body is sent by nginx through X-Accel-Redirect;
+    with MEDIA_ACCEL=sendfile by the front server through X-Sendfile.
+    """
+    full_path = safe_join(app.config['UPLOAD_FOLDER'], path)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+    etag, immutable = media_etag(path, full_path)
+    
+    if app.config['MEDIA_ACCEL'] == 'nginx':
+        response = app.response_class(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+        if response.status_code != 304:
+            response.headers['X-Accel-Redirect'] = app.config['MEDIA_ACCEL_PREFIX'].rstrip('/') + '/' + path
+    else:
+        # send_file honours USE_X_SENDFILE (MEDIA_ACCEL=sendfile)
+        response = send_file(full_path, conditional=True, etag=etag)
+    
+    if immutable:
+        response.headers['Cache-Control'] = f'public, max-age={app.config["MEDIA_MAX_AGE"]}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'  # revalidate with the ETag
+    return response
+
+@notification_dispatcher.on_committed
+def publish_notifications(rows):
+    """Push freshly written notifications to connected /notifications/stream clients"""
+    event_broker.publish_many([(row['user_id'], make_event(row)) for row in rows])
+
+def adjust_unread_count(user_id, delta):
+    """Atomically add delta to a user's unread counter (part of the caller's transaction)"""
+    User.query.filter_by(id=user_id).update(
+        {User.unread_notification_count: db.func.coalesce(User.unread_notification_count, 0) + delta},
+        synchronize_session=False
+    )
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
 # Helper functions
-def create_notification(user_id, type, title, message, related_id=None):
-    """Create a notification for a user"""
-    notification = Notification(
-        user_id=user_id,
-        type=type,
-        title=title,
-        message=message,
-        related_id=related_id
-    )
-    db.session.add(notification)
-    db.session.commit()
+def create_notification(user_id, type, title, message, related_id=None, actor=None):
+    """Create a notification for a user (queued, written by the notification dispatcher)"""
+    notification_dispatcher.enqueue(user_id, type, title, message, related_id, actor)
+
+def create_notifications(rows):
+    """Queue many notifications at once"""
+    notification_dispatcher.enqueue_many(rows)
 
 def create_like_notification(post, user):
     """Create notification when someone likes a post"""
@@ -236,7 +518,8 @@ def create_like_notification(post, user):
             'like',
             f'{user.username} liked your post',
             f'{user.username} liked your post "{post.title}"',
-            post.id
+            post.id,
+            actor=user.username
         )
 
 def create_comment_notification(post, user, comment_content):
@@ -247,7 +530,8 @@ def create_comment_notification(post, user, comment_content):
             'comment',
             f'{user.username} commented on your post',
             f'{user.username} commented: "{comment_content[:50]}{"..." if len(comment_content) > 50 else ""}"',
-            post.id
+            post.id,
+            actor=user.username
         )
 
 def create_follow_notification(followed_user, follower):
@@ -257,60 +541,601 @@ def create_follow_notification(followed_user, follower):
         'follow',
         f'{follower.username} started following you',
         f'{follower.username} started following you',
-        follower.id
+        follower.id,
+        actor=follower.username
+    )
+
+def adjust_post_counter(post_id, column, delta):
+    """Atomically add delta to a denormalized Post counter (part of the caller's transaction)"""
+    Post.query.filter_by(id=post_id).update(
+        {column: db.func.coalesce(column, 0) + delta},
+        synchronize_session=False
     )
 
+def toggle_like(connection, user_id, post_id):
+    """Like or unlike a post in one write transaction.
+    
+    Returns (delta, like_count): -1 unliked, 1 liked, 0 when a concurrent
+    request had just liked it (it stays liked and nothing is counted twice).
+    """
+    likes = Like.__table__
+    posts = Post.__table__
+    unliked = connection.execute(
+        likes.delete().where(likes.c.user_id == user_id, likes.c.post_id == post_id)
+    ).rowcount
+    if unliked:
+        delta = -1
+    else:
+        # A concurrent request (double click) may have just inserted the same like
+        inserted = insert_ignore(likes, [{'user_id': user_id, 'post_id': post_id, 'created_at': datetime.utcnow()}], connection)
+        delta = inserted.rowcount
+    if delta:
+        connection.execute(
+            posts.update().where(posts.c.id == post_id).values(like_count=db.func.coalesce(posts.c.like_count, 0) + delta)
+        )
+    like_count = connection.execute(db.select(posts.c.like_count).where(posts.c.id == post_id)).scalar()
+    return delta, like_count
+
 def process_hashtags(text):
     """Extract hashtags from text and return list of hashtag names"""
-    import re
     hashtags = re.findall(r'#(\w+)', text)
     return [tag.lower() for tag in hashtags]
 
 def process_mentions(text):
     """Extract mentions from text and return list of usernames"""
-    import re
     mentions = re.findall(r'@(\w+)', text)
     return mentions
 
-def create_hashtag_if_not_exists(hashtag_name):
-    """Create a hashtag if it doesn't exist, or return existing one"""
-    hashtag = Hashtag.query.filter_by(name=hashtag_name.lower()).first()
-    if not hashtag:
-        hashtag = Hashtag(name=hashtag_name.lower())
-        db.session.add(hashtag)
-        db.session.commit()
-    return hashtag
-
 def link_hashtags_to_post(post, hashtag_names):
-    """Link hashtags to a post"""
-    for hashtag_name in hashtag_names:
-        hashtag = create_hashtag_if_not_exists(hashtag_name)
-        if hashtag not in post.hashtags:
-            post.hashtags.append(hashtag)
-            hashtag.post_count += 1
+    """Link hashtags to a post.
+    
+    Uses a fixed number of statements in one transaction however many tags
+    there are. Creating missing tags with INSERT ... ON CONFLICT DO NOTHING
+    keeps two uploads racing on the same new tag from failing.
+    """
+    max_length = Hashtag.name.type.length
+    names = sorted({name.lower() for name in hashtag_names if 0 < len(name) <= max_length})
+    if not names:
+        return
+    
+    # Create the tags that don't exist yet, then look all of them up
+    now = datetime.utcnow()
+    insert_ignore(Hashtag.__table__, [{'name': name, 'post_count': 0, 'created_at': now} for name in names], db.session)
+    hashtags = db.session.execute(
+        db.select(Hashtag.id, Hashtag.name, Hashtag.post_count).where(Hashtag.name.in_(names))
+    ).all()
+    
+    # Link only the tags this post doesn't have yet
+    linked_ids = set(db.session.execute(
+        db.select(post_hashtags.c.hashtag_id).where(post_hashtags.c.post_id == post.id)
+    ).scalars())
+    new_hashtags = [hashtag for hashtag in hashtags if hashtag.id not in linked_ids]
+    if new_hashtags:
+        insert_ignore(post_hashtags, [{'post_id': post.id, 'hashtag_id': hashtag.id} for hashtag in new_hashtags], db.session)
+        db.session.execute(
+            db.update(Hashtag)
+            .where(Hashtag.id.in_([hashtag.id for hashtag in new_hashtags]))
+            .values(post_count=Hashtag.post_count + 1)
+        )
     db.session.commit()
+    db.session.expire(post, ['hashtags'])
+    
+    for hashtag in new_hashtags:
+        hashtag_index.add(hashtag.name, (hashtag.post_count or 0) + 1)
+
+def listed_posts():
+    """Post query for feeds and listings, loading what each card shows up front.
+
+    Authors come in the same query; hashtags in one extra IN query per page.
+    Like and comment counts are denormalized columns, so they need nothing.
+    """
+    return Post.query.options(
+        db.joinedload(Post.author),
+        db.selectinload(Post.hashtags)
+    )
+
+def query_trending_posts(limit=20):
+    """Most liked posts created in the last 7 days, straight from the database"""
+    week_ago = datetime.utcnow() - timedelta(days=7)
+    return listed_posts().filter(
+        Post.created_at >= week_ago,
+        Post.like_count > 0
+    ).order_by(Post.like_count.desc()).limit(limit).all()
+
+def load_trending_scores(cutoff):
+    """Like counts for every post created since cutoff (trending engine loader)"""
+    return db.session.query(Post.id, Post.created_at, db.func.count(Like.id)).join(Like).filter(
+        Post.created_at >= cutoff
+    ).group_by(Post.id).all()
 
-def create_mentions_for_post(post, mention_usernames, comment_id=None):
-    """Create mention records for a post or comment"""
-    for username in mention_usernames:
+trending_engine = TrendingEngine(app, load_trending_scores)
+
+def get_trending_posts(limit=20):
+    """Trending posts from the precomputed ranking, falling back to the aggregate query"""
+    post_ids = trending_engine.top(limit)
+    if post_ids is None:
+        return query_trending_posts(limit)
+    
+    return load_posts(post_ids)
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute the denormalized post and unread-notification counters"""
+    like_counts = db.select(db.func.count(Like.id)).where(Like.post_id == Post.id).scalar_subquery()
+    comment_counts = db.select(db.func.count(Comment.id)).where(Comment.post_id == Post.id).scalar_subquery()
+    
+    result = db.session.execute(
+        db.update(Post).where(db.or_(
+            Post.like_count.is_(None),
+            Post.comment_count.is_(None),
+            Post.like_count != like_counts,
+            Post.comment_count != comment_counts
+        )).values(like_count=like_counts, comment_count=comment_counts)
+    )
+    unread_counts = db.select(db.func.count(Notification.id)).where(
+        Notification.user_id == User.id,
+        Notification.is_read == False
+    ).scalar_subquery()
+    user_result = db.session.execute(
+        db.update(User).where(db.or_(
+            User.unread_notification_count.is_(None),
+            User.unread_notification_count != unread_counts
+        )).values(unread_notification_count=unread_counts)
+    )
+    db.session.commit()
+    print(f'Repaired counters on {result.rowcount} posts and {user_result.rowcount} users')
+
+@app.cli.command('search-rebuild')
+def search_rebuild():
+    """Create the full-text search index and index every post"""
+    if search_index is None:
+        print('Full-text search is not supported on this database')
+        return
+    indexed = search_index.rebuild(
+        lambda after_id, limit: Post.query.filter(Post.id > after_id).order_by(Post.id).limit(limit).all()
+    )
+    print(f'Indexed {indexed} posts')
+
+def backfill_media(processor, media_type, batch_size, force):
+    query = Post.query.filter(Post.media_type == media_type)
+    if not force:
+        query = query.filter(Post.variants.is_(None))
+    
+    processed = failed = 0
+    last_id = 0
+    while True:
+        batch = query.with_entities(Post.id, Post.media_path).filter(Post.id > last_id).order_by(Post.id).limit(batch_size).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+        for post_id, ok in processor.process_many(batch):
+            if ok:
+                processed += 1
+            else:
+                failed += 1
+        print(f'Processed {processed} {media_type}s ({failed} failed), up to post {last_id}')
+    print(f'Done: {processed} processed, {failed} failed')
+
+@app.cli.command('images-backfill')
+@click.option('--batch-size', default=100, help='Posts submitted to the pool at a time')
+@click.option('--force', is_flag=True, help='Regenerate posts that already have variants')
+def images_backfill(batch_size, force):
+    """Generate image variants for existing uploads"""
+    backfill_media(image_processor, 'image', batch_size, force)
+
+@app.cli.command('videos-backfill')
+@click.option('--batch-size', default=20, help='Posts submitted to the pool at a time')
+@click.option('--force', is_flag=True, help='Reprocess posts that already have metadata')
+def videos_backfill(batch_size, force):
+    """Extract poster frames and metadata for existing videos"""
+    backfill_media(video_processor, 'video', batch_size, force)
+
+@app.cli.command('media-gc')
+def media_gc():
+    """Delete stored files no post refers to any more"""
+    orphans = MediaBlob.query.filter(
+        MediaBlob.ref_count <= 0,
+        ~db.exists().where(Post.media_path == MediaBlob.path)
+    ).all()
+    for blob in orphans:
+        stem = blob.path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        for name in SIZES:
+            for suffix in ('jpg', 'png', 'webp'):
+                media_store.delete(f'{VARIANT_DIR}/{stem}_{name}.{suffix}')
+        media_store.delete(f'{VARIANT_DIR}/{stem}_poster.jpg')
+        media_store.delete(blob.path)
+        db.session.delete(blob)
+    db.session.commit()
+    print(f'Removed {len(orphans)} unreferenced files')
+
+@app.cli.command('uploads-cleanup')
+def uploads_cleanup():
+    """Delete resumable uploads that expired before completing"""
+    print(f'Removed {chunked_uploads.cleanup()} stale uploads')
+
+@app.cli.command('trending-check')
+def trending_check():
+    """Compare the trending ranking with the database aggregate"""
+    result = trending_engine.check_consistency()
+    print(json.dumps(result, indent=2, default=str))
+
+@app.cli.command('index-advisor')
+@click.option('--user', 'username', help='Request the routes as this user (default: the latest poster)')
+@click.option('--path', 'paths', multiple=True, help='Another path to check (repeatable)')
+def index_advisor(username, paths):
+    """Explain the queries behind the main read routes and flag full scans and sorts"""
+    if username:
         user = User.query.filter_by(username=username).first()
-        if user and user.id != post.user_id:  # Don't mention the post author
-            mention = Mention(
-                post_id=post.id,
-                comment_id=comment_id,
-                mentioned_user_id=user.id
-            )
-            db.session.add(mention)
-            
-            # Create notification for mentioned user
-            create_notification(
-                user.id,
-                'mention',
-                f'You were mentioned in a post by {post.author.username}',
-                f'{post.author.username} mentioned you in their post "{post.title}"',
-                post.id
-            )
+        if user is None:
+            raise click.BadParameter(f'No user named {username}', param_hint='--user')
+    else:
+        user = User.query.join(Post, Post.user_id == User.id).order_by(Post.id.desc()).first()
+    post = Post.query.order_by(Post.id.desc()).first()
+    hashtag = Hashtag.query.order_by(Hashtag.post_count.desc()).first()
+    
+    with app.test_request_context():
+        routes = [
+            url_for('home'),
+            url_for('home', section='trending'),
+            url_for('trending'),
+            url_for('trending_hashtags'),
+        ]
+        if user is not None:
+            routes += [
+                url_for('home', section='following'),
+                url_for('profile', username=user.username),
+                url_for('notifications'),
+                url_for('unread_notification_count'),
+            ]
+        if post is not None:
+            routes += [
+                url_for('view_post', post_id=post.id),
+                url_for('search', q=post.title.split()[0] if post.title.split() else 'a'),
+            ]
+        if hashtag is not None:
+            routes.append(url_for('hashtag_posts', hashtag_name=hashtag.name))
+    
+    def reset():
+        # Cached pages would be served without running their queries; the CLI's
+        # app context (and so `g`) is shared by every replayed request
+        page_cache.clear()
+        g.pop('_liked_posts', None)
+    
+    # The routes run against the real database, so switch off the writes GET requests make
+    # (an unbuilt timeline is read from the posts table instead)
+    view_counter.enabled = False
+    app.config['TIMELINE_BUILD_ON_READ'] = False
+    try:
+        report = IndexAdvisor(app, db).run(routes + list(paths), user.id if user else None, reset)
+    finally:
+        view_counter.enabled = True
+        app.config['TIMELINE_BUILD_ON_READ'] = True
+    flagged = 0
+    for entry in report:
+        print(f"GET {entry['path']}  {entry['status']}, {entry['queries']} queries")
+        if entry['writes']:
+            print(f"    ⚠ wrote to the database: {'; '.join(' '.join(s.split())[:80] for s in entry['writes'])}")
+        for kind, table, line, statement in entry['findings']:
+            flagged += 1
+            print(f"    {kind}{' of ' + table if table else ''}: {line}")
+            print(f"        {' '.join(statement.split())[:200]}")
+    print(f'{flagged} full scans or sorts on {sum(1 for entry in report if entry["findings"])} of {len(report)} routes')
+
+def create_mentions_for_post(post, mention_usernames, comment_id=None, author=None):
+    """Create mention records and notifications for a post or comment.
+    
+    All usernames are resolved in one query, the mentions are bulk inserted
+    in a single transaction and the notifications are queued as one batch.
+    Repeated mentions count once, and at most MENTION_NOTIFICATION_LIMIT
+    users are notified per post or comment.
+    """
+    author = author or post.author
+    usernames = list(dict.fromkeys(mention_usernames))  # dedupe, keep first-mention order
+    if not usernames:
+        return
+    
+    user_ids = dict(db.session.execute(
+        db.select(User.username, User.id).where(User.username.in_(usernames))
+    ).all())
+    # Don't mention the post author or the person writing
+    mentioned_ids = [
+        user_ids[username] for username in usernames
+        if username in user_ids and user_ids[username] not in (post.user_id, author.id)
+    ]
+    if not mentioned_ids:
+        return
+    
+    db.session.execute(db.insert(Mention), [
+        {'post_id': post.id, 'comment_id': comment_id, 'mentioned_user_id': user_id}
+        for user_id in mentioned_ids
+    ])
+    
+    if comment_id is None:
+        title = f'You were mentioned in a post by {author.username}'
+        message = f'{author.username} mentioned you in their post "{post.title}"'
+    else:
+        title = f'You were mentioned in a comment by {author.username}'
+        message = f'{author.username} mentioned you in a comment on "{post.title}"'
+    
     db.session.commit()
+    
+    limit = app.config.get('MENTION_NOTIFICATION_LIMIT', 20)
+    create_notifications([
+        {'user_id': user_id, 'type': 'mention', 'title': title, 'message': message, 'related_id': post.id}
+        for user_id in mentioned_ids[:limit]
+    ])
+
+def get_liked_post_ids(posts):
+    """Return the ids of `posts` that the current user has liked.
+    
+    Only the posts being rendered are looked up (one indexed IN query), and
+    the answers are kept for the rest of the request. They are not cached
+    across requests: a like handled by another worker would show as stale.
+    """
+    return liked_post_ids(post.id for post in posts)
+
+def liked_post_ids(post_ids):
+    """The subset of `post_ids` the current user has liked (see get_liked_post_ids)"""
+    if not current_user.is_authenticated:
+        return set()
+    
+    post_ids = set(post_ids)
+    if not post_ids:
+        return set()
+    
+    known = g.setdefault('_liked_posts', {})
+    missing = post_ids - known.keys()
+    if missing:
+        liked = {
+            post_id for (post_id,) in db.session.query(Like.post_id).filter(
+                Like.user_id == current_user.id,
+                Like.post_id.in_(missing)
+            )
+        }
+        known.update((post_id, post_id in liked) for post_id in missing)
+    
+    return {post_id for post_id in post_ids if known.get(post_id)}
+
+def get_before_cursor():
+    """Decode the ?before= cursor of the current request"""
+    try:
+        return decode_cursor(request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+def paginate_posts(query):
+    """Apply ?before=<cursor> keyset pagination to a Post query"""
+    return keyset_paginate(query, Post, get_before_cursor(), app.config.get('FEED_PAGE_SIZE', 20))
+
+def followed_ids_query(user_id):
+    """Subquery of the ids a user follows"""
+    return db.select(followers.c.followed_id).where(followers.c.follower_id == user_id)
+
+def recent_post_keys(author_filter, before=None, limit=20):
+    """(created_at, id, user_id) of the newest posts matching author_filter"""
+    query = db.session.query(Post.created_at, Post.id, Post.user_id).filter(author_filter)
+    if before is not None:
+        query = query.filter(db.tuple_(Post.created_at, Post.id) < db.tuple_(*before))
+    return [tuple(row) for row in query.order_by(Post.created_at.desc(), Post.id.desc()).limit(limit)]
+
+def build_timeline(user_id):
+    """Materialize a user's following timeline from the posts table"""
+    author_filter = Post.user_id.in_(followed_ids_query(user_id))
+    pull_authors = timeline_store.pull_authors()
+    if pull_authors:
+        author_filter = db.and_(author_filter, Post.user_id.notin_(pull_authors))
+    timeline_store.build(user_id, recent_post_keys(author_filter, limit=timeline_store.max_length))
+
+def fan_out_post(post):
+    """Push a new post to its author's followers, or mark the author for fan-out-on-read"""
+    if timeline_store is None:
+        return
+    
+    max_followers = app.config.get('FANOUT_MAX_FOLLOWERS', 10000)
+    follower_ids = db.session.execute(
+        db.select(followers.c.follower_id).where(followers.c.followed_id == post.user_id).limit(max_followers + 1)
+    ).scalars().all()
+    
+    if len(follower_ids) > max_followers:
+        timeline_store.add_pull_author(post.user_id)
+    else:
+        timeline_store.push(follower_ids, post.created_at, post.id, post.user_id)
+
+def following_posts(user_id):
+    """One page of the following feed as (posts, next_cursor)"""
+    if timeline_store is None:
+        return paginate_posts(listed_posts().filter(Post.user_id.in_(followed_ids_query(user_id))))
+    
+    before = get_before_cursor()
+    limit = app.config.get('FEED_PAGE_SIZE', 20)
+    
+    if app.config.get('TIMELINE_BUILD_ON_READ', True) and not timeline_store.exists(user_id):
+        # A lagging replica may not show a timeline the primary already has;
+        # check again and build there, so each read in the lag window doesn't
+        # rebuild it from stale posts
+        replica_router.use_primary(stick=True)
+        if not timeline_store.exists(user_id):
+            build_timeline(user_id)
+            db.session.commit()
+    
+    keys = timeline_store.page(user_id, before, limit + 1)
+    if len(keys) < limit + 1:
+        # Past the end of the materialized timeline, read older posts directly
+        after = keys[-1] if keys else before
+        keys += [
+            (created_at, post_id) for created_at, post_id, _ in
+            recent_post_keys(Post.user_id.in_(followed_ids_query(user_id)), after, limit + 1 - len(keys))
+        ]
+    
+    # Merge in posts from followed authors that are too big to fan out
+    pull_authors = timeline_store.pull_authors()
+    if pull_authors:
+        followed_pull_authors = db.session.execute(
+            followed_ids_query(user_id).where(followers.c.followed_id.in_(pull_authors))
+        ).scalars().all()
+        if followed_pull_authors:
+            keys += [
+                (created_at, post_id) for created_at, post_id, _ in
+                recent_post_keys(Post.user_id.in_(followed_pull_authors), before, limit + 1)
+            ]
+    
+    keys = sorted(set(keys), reverse=True)[:limit + 1]
+    next_cursor = None
+    if len(keys) > limit:
+        keys = keys[:limit]
+        next_cursor = encode_cursor(*keys[-1])
+    
+    return load_posts([post_id for _, post_id in keys]), next_cursor
+
+def serialize_post(post, liked_posts):
+    """JSON representation of a post for feed responses"""
+    return {
+        'id': post.id,
+        'title': post.title,
+        'description': post.description,
+        'media_type': post.media_type,
+        'media_url': media_url(post),
+        'thumbnail_url': media_url(post, 'thumb'),
+        'feed_url': media_url(post, 'feed'),
+        'feed_webp_url': media_url(post, 'feed_webp') if post.variants else None,
+        'poster_url': media_url(post, 'poster') if post.variants and 'poster' in post.variants else None,
+        'width': post.width,
+        'height': post.height,
+        'duration': post.duration,
+        'tags': post.tags,
+        'author': post.author.username,
+        'created_at': post.created_at.isoformat() if post.created_at else None,
+        'view_count': post.view_count or 0,
+        'like_count': post.like_count,
+        'comment_count': post.comment_count,
+        'liked': post.id in liked_posts
+    }
+
+def render_feed(template, posts, next_cursor=None, **context):
+    """Render a feed page, or its JSON variant for infinite scroll (?format=json)"""
+    liked_posts = get_liked_post_ids(posts)
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'posts': [serialize_post(post, liked_posts) for post in posts],
+            'next_cursor': next_cursor
+        })
+    
+    return render_template(template, posts=posts, liked_posts=liked_posts, next_cursor=next_cursor, **context)
+
+def cached_feed(key, load, template, **context):
+    """render_feed backed by the shared page cache.
+    
+    `key` is (route, scope) such as ('home', 'for_you') or ('profile', username);
+    the ?before cursor is added to it. `load()` returns (posts, next_cursor) on
+    a miss. Every visitor shares the cached post list and only their like
+    state is looked up; anonymous visitors also share the rendered HTML.
+    Entries live for PAGE_CACHE_TTL and are dropped early by invalidate_feeds.
+    """
+    key = key + (request.args.get('before', ''),)
+    entry = page_cache.get(key)
+    posts = None
+    if entry is None:
+        posts, next_cursor = load()
+        entry = {
+            'post_ids': [post.id for post in posts],
+            'posts': [serialize_post(post, ()) for post in posts],
+            'next_cursor': next_cursor,
+            'html': None,
+        }
+        entry['size'] = len(json.dumps(entry['posts'], default=str))
+        page_cache.set(key, entry, size=entry['size'])
+    
+    if request.args.get('format') == 'json':
+        liked = liked_post_ids(entry['post_ids'])
+        return jsonify({
+            'posts': [dict(post, liked=post['id'] in liked) for post in entry['posts']],
+            'next_cursor': entry['next_cursor']
+        })
+    
+    shareable = not current_user.is_authenticated and '_flashes' not in session
+    if shareable and entry['html'] is not None:
+        return entry['html']
+    
+    if posts is None:
+        posts = load_posts(entry['post_ids'])
+    html = render_feed(template, posts, entry['next_cursor'], **context)
+    if shareable:
+        entry['html'] = html
+        page_cache.set(key, entry, size=entry['size'] + len(html))
+    return html
+
+def load_posts(post_ids):
+    """Posts by id, in the given order (deleted ones are skipped)"""
+    if not post_ids:
+        return []
+    posts = {post.id: post for post in listed_posts().filter(Post.id.in_(post_ids))}
+    return [posts[post_id] for post_id in post_ids if post_id in posts]
+
+def invalidate_feeds(*scopes):
+    """Drop this worker's cached pages for (route, scope) pairs, e.g. ('home', 'trending')"""
+    page_cache.delete_where(lambda key: key[:2] in scopes)
+
+def file_extension(filename):
+    return filename.lower().rsplit('.', 1)[-1]
+
+def media_type_for(filename):
+    """'image' or 'video' from the file extension, None if unsupported"""
+    file_ext = file_extension(filename)
+    if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
+        return 'image'
+    if file_ext in ['mp4', 'avi', 'mov', 'wmv']:
+        return 'video'
+    return None
+
+def publish_post(post):
+    """Everything that follows saving a new post: variants, fan-out, hashtags, mentions, search"""
+    # Thumbnails, posters and video metadata are generated in the background,
+    # unless another post already uses the same file
+    twin = Post.query.filter(
+        Post.media_path == post.media_path,
+        Post.id != post.id,
+        Post.variants.isnot(None)
+    ).first()
+    if twin is not None:
+        for column in ('width', 'height', 'variants', 'duration', 'video_codec'):
+            setattr(post, column, getattr(twin, column))
+        db.session.commit()
+    elif post.media_type == 'image':
+        image_processor.submit(post.id, post.media_path)
+    else:
+        video_processor.submit(post.id, post.media_path)
+    
+    # Push the post to followers' timelines; the post is already committed,
+    # so a failure is logged instead of failing the upload
+    try:
+        fan_out_post(post)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception('Fan-out of post %s failed', post.id)
+    
+    # Process hashtags and mentions
+    if post.description:
+        hashtags = process_hashtags(post.description)
+        mentions = process_mentions(post.description)
+        
+        if hashtags:
+            link_hashtags_to_post(post, hashtags)
+        
+        if mentions:
+            create_mentions_for_post(post, mentions)
+    
+    # Add the post (with its hashtags) to the search index
+    if search_index is not None:
+        search_index.index_post(post)
+        db.session.commit()
+    
+    invalidate_feeds(
+        ('home', 'for_you'),
+        ('profile', post.author.username),
+        *(('hashtag', hashtag.name) for hashtag in post.hashtags)
+    )
 
 # Helper function to check if user has accepted ToS
 def tos_required(f):
@@ -328,32 +1153,18 @@ def home():
     section = request.args.get('section', 'for_you')
     
     if section == 'following' and current_user.is_authenticated:
-        # Show posts from users the current user follows
-        following_ids = [user.id for user in current_user.following]
-        if following_ids:
-            posts = Post.query.filter(Post.user_id.in_(following_ids)).order_by(Post.created_at.desc()).limit(20).all()
-        else:
-            posts = []
+        # Show posts from users the current user follows (per user, so not page-cached)
+        posts, next_cursor = following_posts(current_user.id)
+        if not posts and current_user.following.first() is None:
             flash('Follow some users to see their posts here!')
+        return render_feed('home.html', posts, next_cursor, section=section)
     elif section == 'trending':
         # Show trending posts (most liked in last 7 days)
-        from datetime import timedelta
-        week_ago = datetime.utcnow() - timedelta(days=7)
-        posts = db.session.query(Post).join(Like).filter(
-            Post.created_at >= week_ago
-        ).group_by(Post.id).order_by(
-            db.func.count(Like.id).desc()
-        ).limit(20).all()
+        return cached_feed(('home', 'trending'), lambda: (get_trending_posts(20), None), 'home.html', section=section)
     else:
-        # Default: Show recent posts from all users (For You page)
-        posts = Post.query.order_by(Post.created_at.desc()).limit(20).all()
-    
-    # Get liked posts for current user if authenticated
-    liked_posts = set()
-    if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
-    
-    return render_template('home.html', posts=posts, liked_posts=liked_posts, section=section)
+        # Default: Show recent posts from all users (For You page); anonymous
+        # ?section=following and unknown sections share its cached page
+        return cached_feed(('home', 'for_you'), lambda: paginate_posts(listed_posts()), 'home.html', section='for_you')
 
 @app.route('/tos', methods=['GET', 'POST'])
 @login_required
@@ -394,6 +1205,7 @@ def register():
         )
         db.session.add(user)
         db.session.commit()
+        user_index.add(user.username, 0)
         
         flash('Registration successful! Please login.')
         return redirect(url_for('login'))
@@ -443,23 +1255,14 @@ def upload():
             return redirect(request.url)
         
         if file:
-            filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-            filename = timestamp + filename
-            
-            # Determine media type
-            file_ext = filename.lower().split('.')[-1]
-            
-            if file_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                media_type = 'image'
-            elif file_ext in ['mp4', 'avi', 'mov', 'wmv']:
-                media_type = 'video'
-            else:
+            original_name = secure_filename(file.filename)
+            media_type = media_type_for(original_name)
+            if media_type is None:
                 flash('Unsupported file type')
                 return redirect(request.url)
             
             try:
-                file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+                filename, size = media_store.save_stream(file.stream, file_extension(original_name))
             except Exception as e:
                 flash('Error saving file. Please try again.')
                 return redirect(request.url)
@@ -473,36 +1276,176 @@ def upload():
                 user_id=current_user.id
             )
             db.session.add(post)
+            acquire_blob(filename, size)
             db.session.commit()
-            
-            # Process hashtags and mentions
-            if description:
-                hashtags = process_hashtags(description)
-                mentions = process_mentions(description)
-                
-                if hashtags:
-                    link_hashtags_to_post(post, hashtags)
-                
-                if mentions:
-                    create_mentions_for_post(post, mentions)
+            publish_post(post)
             
             flash('Post uploaded successfully!')
             return redirect(url_for('home'))
     
     return render_template('upload.html')
 
+# Resumable uploads (tus 1.0: creation, checksum, termination and expiration extensions)
+def tus_response(status=204, **headers):
+    response = app.response_class(status=status)
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    for name, value in headers.items():
+        response.headers[name.replace('_', '-')] = str(value)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def get_own_upload(upload_id):
+    info = chunked_uploads.get(upload_id)
+    if info['user_id'] != current_user.id:
+        raise UploadError('Upload not found', 404)
+    return info
+
+def upload_expires(info):
+    return http_date(info['expires_at'])
+
+@app.errorhandler(UploadError)
+def handle_upload_error(e):
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    response.headers['Tus-Resumable'] = TUS_VERSION
+    return response
+
+@app.before_request
+def check_tus_version():
+    if not request.path.startswith('/uploads') or request.method == 'OPTIONS':
+        return None
+    version = request.headers.get('Tus-Resumable')
+    if version and version != TUS_VERSION:
+        return tus_response(412, Tus_Version=TUS_VERSION)
+
+@app.route('/uploads', methods=['OPTIONS'])
+def chunked_upload_options():
+    return tus_response(
+        Tus_Version=TUS_VERSION,
+        Tus_Extension='creation,checksum,termination,expiration',
+        Tus_Max_Size=max(app.config['UPLOAD_MAX_SIZE'].values()),
+        Tus_Checksum_Algorithm=','.join(CHECKSUM_ALGORITHMS)
+    )
+
+@app.route('/uploads', methods=['POST'])
+@tos_required
+def create_chunked_upload():
+    """Start a resumable upload; title, description, tags and filename come in Upload-Metadata"""
+    try:
+        length = int(request.headers['Upload-Length'])
+    except (KeyError, ValueError):
+        raise UploadError('Upload-Length is required')
+    
+    metadata = parse_metadata(request.headers.get('Upload-Metadata'))
+    filename = secure_filename(metadata.get('filename', ''))
+    if not filename or not metadata.get('title'):
+        raise UploadError('Upload-Metadata must include filename and title')
+    media_type = media_type_for(filename)
+    if media_type is None:
+        raise UploadError('Unsupported file type', 415)
+    max_size = app.config['UPLOAD_MAX_SIZE'][media_type]
+    if not 0 < length <= max_size:
+        raise UploadError(f'{media_type.capitalize()} uploads must be between 1 byte and {max_size} bytes', 413)
+    
+    upload_id = chunked_uploads.create(length, {
+        'user_id': current_user.id,
+        'filename': filename,
+        'media_type': media_type,
+        'title': metadata['title'],
+        'description': metadata.get('description', ''),
+        'tags': metadata.get('tags', ''),
+    })
+    upload_cleanup.ensure_started()
+    
+    info = chunked_uploads.get(upload_id)
+    return tus_response(
+        201,
+        Location=url_for('chunked_upload', upload_id=upload_id, _external=True),
+        Upload_Offset=0,
+        Upload_Expires=upload_expires(info)
+    )
+
+@app.route('/uploads/<upload_id>', methods=['HEAD', 'PATCH', 'DELETE'])
+@tos_required
+def chunked_upload(upload_id):
+    info = get_own_upload(upload_id)
+    
+    if request.method == 'HEAD':
+        return tus_response(
+            200,
+            Upload_Offset=info['offset'],
+            Upload_Length=info['length'],
+            Upload_Expires=upload_expires(info)
+        )
+    
+    if request.method == 'DELETE':
+        chunked_uploads.delete(upload_id)
+        return tus_response()
+    
+    if request.mimetype != 'application/offset+octet-stream':
+        raise UploadError('Content-Type must be application/offset+octet-stream', 415)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        raise UploadError('Upload-Offset is required')
+    checksum = parse_checksum(request.headers.get('Upload-Checksum'))
+    
+    info, _ = chunked_uploads.append(upload_id, offset, request.stream, checksum)
+    headers = {'Upload_Offset': info['offset'], 'Upload_Expires': upload_expires(info)}
+    # Also for a repeated final PATCH when publishing the post failed the first time
+    if info['offset'] == info['length']:
+        post = finalize_chunked_upload(info['id'])
+        headers['X_Post_Id'] = post.id
+        headers['X_Post_Url'] = url_for('view_post', post_id=post.id)
+    return tus_response(**headers)
+
+def finalize_chunked_upload(upload_id):
+    """Add a finished upload to the media store and publish it as a post.
+    
+    The partial upload is only deleted once the post is committed, so a
+    failure here leaves it complete and the final PATCH can be retried.
+    """
+    with chunked_uploads.locked(upload_id):
+        info = chunked_uploads.get(upload_id)  # 404 if a concurrent request already published it
+        try:
+            filename, size = media_store.save_file(
+                chunked_uploads.path(upload_id), file_extension(info['filename']), move=False
+            )
+            post = Post(
+                title=info['title'],
+                description=info['description'],
+                media_type=info['media_type'],
+                media_path=filename,
+                tags=info['tags'],
+                user_id=info['user_id']
+            )
+            db.session.add(post)
+            acquire_blob(filename, size)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Could not publish upload %s', upload_id)
+            raise UploadError('Could not publish the upload, send the last PATCH again to retry', 503)
+        chunked_uploads.delete(upload_id)
+    publish_post(post)
+    return post
+
 @app.route('/post/<int:post_id>')
 def view_post(post_id):
-    post = Post.query.get_or_404(post_id)
+    post = Post.query.options(
+        db.joinedload(Post.author),
+        db.selectinload(Post.hashtags),
+        db.selectinload(Post.comments).options(
+            db.joinedload(Comment.author),
+            db.selectinload(Comment.replies).joinedload(Comment.author)
+        )
+    ).filter_by(id=post_id).first_or_404()
     
-    # Increment view count
-    post.view_count += 1
-    db.session.commit()
+    # Increment view count (written in batches by the view counter)
+    view_counter.increment(post.id)
     
     # Get liked posts for current user if authenticated
-    liked_posts = set()
-    if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
+    liked_posts = get_liked_post_ids([post])
     
     return render_template('view_post.html', post=post, liked_posts=liked_posts)
 
@@ -523,12 +1466,13 @@ def add_comment(post_id):
     )
     
     db.session.add(comment)
+    adjust_post_counter(post_id, Post.comment_count, 1)
     db.session.commit()
     
     # Process mentions in comment
     mentions = process_mentions(content)
     if mentions:
-        create_mentions_for_post(post, mentions, comment.id)
+        create_mentions_for_post(post, mentions, comment.id, author=current_user)
     
     # Create notification for the post author
     create_comment_notification(post, current_user, content)
@@ -554,6 +1498,7 @@ def reply_to_comment(comment_id):
     )
     
     db.session.add(reply)
+    adjust_post_counter(parent_comment.post_id, Post.comment_count, 1)
     db.session.commit()
     
     flash('Reply added successfully!')
@@ -571,6 +1516,7 @@ def delete_comment(comment_id):
     
     post_id = comment.post_id
     db.session.delete(comment)
+    adjust_post_counter(post_id, Post.comment_count, -1)
     db.session.commit()
     
     flash('Comment deleted successfully!')
@@ -588,95 +1534,83 @@ def follow_user(username):
     if current_user.following.filter_by(id=user_to_follow.id).first():
         # Unfollow
         current_user.following.remove(user_to_follow)
+        if timeline_store is not None:
+            timeline_store.remove_author(current_user.id, user_to_follow.id)
         db.session.commit()
-        return jsonify({'following': False, 'count': user_to_follow.followers.count()})
+        follower_count = user_to_follow.followers.count()
+        user_index.add(user_to_follow.username, follower_count)
+        return jsonify({'following': False, 'count': follower_count})
     else:
         # Follow
         current_user.following.append(user_to_follow)
+        if timeline_store is not None:
+            # Backfill the followed user's recent posts into the timeline
+            timeline_store.add_many(current_user.id, recent_post_keys(
+                Post.user_id == user_to_follow.id, limit=app.config.get('TIMELINE_BACKFILL', 100)
+            ))
         db.session.commit()
         
         # Create notification for the followed user
         create_follow_notification(user_to_follow, current_user)
         
-        return jsonify({'following': True, 'count': user_to_follow.followers.count()})
+        follower_count = user_to_follow.followers.count()
+        user_index.add(user_to_follow.username, follower_count)
+        return jsonify({'following': True, 'count': follower_count})
 
 @app.route('/following')
 @tos_required
 def following_feed():
     # Get posts from users the current user follows
-    following_ids = [user.id for user in current_user.following]
-    posts = Post.query.filter(Post.user_id.in_(following_ids)).order_by(Post.created_at.desc()).limit(20).all()
+    posts, next_cursor = following_posts(current_user.id)
     
-    # Get liked posts for current user
-    liked_posts = {like.post_id for like in current_user.user_likes}
-    
-    return render_template('home.html', posts=posts, liked_posts=liked_posts, section='following')
+    return render_feed('home.html', posts, next_cursor, section='following')
 
 @app.route('/trending')
 def trending():
     # Get posts with most likes in the last 7 days
-    from datetime import timedelta
-    week_ago = datetime.utcnow() - timedelta(days=7)
-    
-    posts = db.session.query(Post).join(Like).filter(
-        Post.created_at >= week_ago
-    ).group_by(Post.id).order_by(
-        db.func.count(Like.id).desc()
-    ).limit(20).all()
-    
-    # Get liked posts for current user if authenticated
-    liked_posts = set()
-    if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
-    
-    return render_template('home.html', posts=posts, liked_posts=liked_posts, section='trending')
+    return cached_feed(('home', 'trending'), lambda: (get_trending_posts(20), None), 'home.html', section='trending')
 
 @app.route('/profile/<username>')
 def profile(username):
     user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all()
     
-    # Get liked posts for current user if authenticated
-    liked_posts = set()
     is_following = False
     if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
         is_following = current_user.following.filter_by(id=user.id).first() is not None
     
-    return render_template('profile.html', user=user, posts=posts, liked_posts=liked_posts, is_following=is_following)
+    return cached_feed(
+        ('profile', user.username),
+        lambda: paginate_posts(listed_posts().filter_by(user_id=user.id)),
+        'profile.html', user=user, is_following=is_following
+    )
 
 @app.route('/like/<int:post_id>', methods=['POST'])
 @tos_required
 def like_post(post_id):
     post = Post.query.get_or_404(post_id)
-    existing_like = Like.query.filter_by(user_id=current_user.id, post_id=post_id).first()
+    user_id = current_user.id
     
-    if existing_like:
-        db.session.delete(existing_like)
-        db.session.commit()
-        return jsonify({'liked': False, 'count': len(post.likes)})
-    else:
-        like = Like(user_id=current_user.id, post_id=post_id)
-        db.session.add(like)
-        db.session.commit()
-        
+    # Through the write queue when enabled, so concurrent likes share a commit
+    delta, like_count = write_queue.execute(lambda conn: toggle_like(conn, user_id, post_id))
+    if delta:
+        trending_engine.record_like(post.id, post.created_at, delta)
+        invalidate_feeds(('home', 'trending'))
+    
+    if delta > 0:
         # Create notification for the post author
         create_like_notification(post, current_user)
-        
-        return jsonify({'liked': True, 'count': len(post.likes)})
+    
+    return jsonify({'liked': delta >= 0, 'count': like_count})
 
 @app.route('/hashtag/<hashtag_name>')
 def hashtag_posts(hashtag_name):
     """Show all posts with a specific hashtag"""
     hashtag = Hashtag.query.filter_by(name=hashtag_name.lower()).first_or_404()
-    posts = hashtag.posts.order_by(Post.created_at.desc()).all()
-    
-    # Get liked posts for current user if authenticated
-    liked_posts = set()
-    if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
-    
-    return render_template('hashtag.html', hashtag=hashtag, posts=posts, liked_posts=liked_posts)
+    return cached_feed(
+        ('hashtag', hashtag.name),
+        lambda: paginate_posts(listed_posts().join(post_hashtags).filter(post_hashtags.c.hashtag_id == hashtag.id)),
+        'hashtag.html', hashtag=hashtag
+    )
 
 @app.route('/trending-hashtags')
 def trending_hashtags():
@@ -688,30 +1622,69 @@ def trending_hashtags():
 def search():
     """Enhanced search with hashtag and mention support"""
     query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = 20
     if not query:
         return render_template('search.html', posts=[], hashtags=[], users=[])
     
-    # Search posts by title, description, or hashtags
-    posts = Post.query.filter(
-        db.or_(
-            Post.title.contains(query),
-            Post.description.contains(query)
-        )
-    ).order_by(Post.created_at.desc()).limit(20).all()
+    # Search posts by title, description, tags and hashtags
+    if search_index is not None and search_index.available():
+        # Ranked by relevance from the full-text index
+        post_ids, has_more = search_index.search(query, page, per_page)
+        posts = load_posts(post_ids)
+    else:
+        posts = listed_posts().filter(
+            db.or_(
+                Post.title.contains(query),
+                Post.description.contains(query)
+            )
+        ).order_by(Post.created_at.desc()).offset((page - 1) * per_page).limit(per_page + 1).all()
+        has_more = len(posts) > per_page
+        posts = posts[:per_page]
     
-    # Search hashtags
-    hashtags = Hashtag.query.filter(Hashtag.name.contains(query.lower())).limit(10).all()
+    # Search hashtags and users by prefix, best ranked first
+    term = query.lstrip('#@')
+    hashtag_names = [name for name, _ in suggest(hashtag_index, Hashtag, Hashtag.name, term.lower(), 10)]
+    hashtags_by_name = {h.name: h for h in Hashtag.query.filter(Hashtag.name.in_(hashtag_names))} if hashtag_names else {}
+    hashtags = [hashtags_by_name[name] for name in hashtag_names if name in hashtags_by_name]
     
-    # Search users
-    users = User.query.filter(User.username.contains(query)).limit(10).all()
+    usernames = [name for name, _ in suggest(user_index, User, User.username, term, 10)]
+    users_by_name = {u.username: u for u in User.query.filter(User.username.in_(usernames))} if usernames else {}
+    users = [users_by_name[name] for name in usernames if name in users_by_name]
     
     # Get liked posts for current user if authenticated
-    liked_posts = set()
-    if current_user.is_authenticated:
-        liked_posts = {like.post_id for like in current_user.user_likes}
+    liked_posts = get_liked_post_ids(posts)
     
     return render_template('search.html', posts=posts, hashtags=hashtags, users=users, 
-                         liked_posts=liked_posts, query=query)
+                         liked_posts=liked_posts, query=query, page=page, has_more=has_more)
+
+@app.route('/autocomplete')
+def autocomplete():
+    """Typeahead suggestions for @mentions and #hashtags"""
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('type')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 20)
+    
+    if query.startswith('@'):
+        kind, query = 'user', query[1:]
+    elif query.startswith('#'):
+        kind, query = 'hashtag', query[1:]
+    
+    result = {}
+    if kind in (None, 'user'):
+        result['users'] = [
+            {'username': name, 'followers': score}
+            for name, score in suggest(user_index, User, User.username, query, limit)
+        ]
+    if kind in (None, 'hashtag'):
+        result['hashtags'] = [
+            {'name': name, 'post_count': score}
+            for name, score in suggest(hashtag_index, Hashtag, Hashtag.name, query.lower(), limit)
+        ]
+    
+    response = jsonify(result)
+    response.headers['Cache-Control'] = 'public, max-age=30'
+    return response
 
 @app.route('/notifications')
 @tos_required
@@ -733,7 +1706,12 @@ def mark_notification_read(notification_id):
     if notification.user_id != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    notification.is_read = True
+    # Only count the notification once, even if two requests race to mark it
+    updated = Notification.query.filter_by(id=notification.id, is_read=False).update(
+        {'is_read': True}, synchronize_session=False
+    )
+    if updated:
+        adjust_unread_count(current_user.id, -updated)
     db.session.commit()
     
     return jsonify({'success': True})
@@ -741,12 +1719,65 @@ def mark_notification_read(notification_id):
 @app.route('/notifications/mark-all-read', methods=['POST'])
 @tos_required
 def mark_all_notifications_read():
-    Notification.query.filter_by(user_id=current_user.id, is_read=False).update({'is_read': True})
+    updated = Notification.query.filter_by(user_id=current_user.id, is_read=False).update({'is_read': True})
+    if updated:
+        adjust_unread_count(current_user.id, -updated)
     db.session.commit()
     
     flash('All notifications marked as read!')
     return redirect(url_for('notifications'))
 
+@app.route('/notifications/stream')
+@tos_required
+def notification_stream():
+    """Server-Sent Events stream of new notifications for the current user"""
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        last_id = 0
+    
+    subscription = event_broker.subscribe(current_user.id)
+    if subscription is None:
+        response = jsonify({'error': 'Too many live connections, try again shortly'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    # Subscribed before reading the backlog, so nothing written in between is lost
+    backlog = []
+    if last_id:
+        missed = Notification.query.filter(
+            Notification.user_id == current_user.id,
+            Notification.id > last_id
+        ).order_by(Notification.id.desc()).limit(app.config['LIVE_REPLAY_LIMIT']).all()
+        backlog = [make_event(notification) for notification in reversed(missed)]
+    db.session.remove()  # don't hold a connection for the life of the stream
+    
+    response = Response(
+        event_broker.stream(
+            subscription,
+            backlog,
+            heartbeat=app.config['LIVE_HEARTBEAT_INTERVAL'],
+            timeout=app.config['LIVE_STREAM_TIMEOUT']
+        ),
+        mimetype='text/event-stream'
+    )
+    response.call_on_close(lambda: event_broker.unsubscribe(subscription))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx: flush events immediately
+    return response
+
+@app.route('/notifications/unread-count')
+@login_required
+def unread_notification_count():
+    """Unread badge count; cheap to poll thanks to ETag / 304"""
+    count = max(current_user.unread_notification_count or 0, 0)
+    
+    response = jsonify({'unread': count})
+    response.set_etag(f'unread-{current_user.id}-{count}')
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
 # Support and Reporting Routes
 @app.route('/support', methods=['GET', 'POST'])
 @tos_required
@@ -879,6 +1910,25 @@ def report_comment(comment_id):
 def contact():
     return render_template('contact.html')
 
+@app.route('/metrics')
+def metrics():
+    """Internal performance counters for this worker"""
+    if not app.config.get('METRICS_ENABLED'):
+        abort(404)
+    
+    return jsonify({
+        'view_counter': view_counter.stats(),
+        'trending': trending_engine.stats(),
+        'notifications': notification_dispatcher.stats(),
+        'live': event_broker.stats(),
+        'images': image_processor.stats(),
+        'videos': video_processor.stats(),
+        'page_cache': page_cache.stats(),
+        'write_queue': write_queue.stats(),
+        'database_pool': pool_stats(db.engine),
+        'replica': replica_router.stats()
+    })
+
 if __name__ == '__main__':
     # Only run in development mode
     if app.config.get('DEBUG', False):
@@ -0,0 +1,127 @@
+"""
+Prefix indexes for @username and #hashtag autocomplete.
+Keys live in one sorted array searched with bisect. Prefixes that match
+more than SCAN_LIMIT keys get their top results cached, so every lookup
+touches at most SCAN_LIMIT entries. The one and two letter prefixes, the
+most common and the most expensive to rank, are cached up front by load().
+"""
+
+import heapq
+import threading
+from bisect import bisect_left, insort
+
+SEPARATOR = '\x00'  # sorts before every printable character
+
+
+class PrefixIndex:
+    """Case-insensitive prefix index of names ranked by a score"""
+
+    SCAN_LIMIT = 256
+    PRECOMPUTED_LENGTH = 2  # prefixes up to this many characters are ranked during load()
+
+    def __init__(self, top_k=10):
+        self.top_k = top_k
+        # Cached rankings keep spare entries, so a cached name losing score
+        # shortens the list instead of forcing a rescan of the whole range
+        self.cache_depth = top_k * 2
+        self._keys = []        # sorted "<lowercase name>\0<name>"
+        self._scores = {}      # key -> score
+        self._top_cache = {}   # prefix -> [key, ...] best first, for very common prefixes
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    @staticmethod
+    def _key(name):
+        return f'{name.lower()}{SEPARATOR}{name}'
+
+    @staticmethod
+    def _name(key):
+        return key.split(SEPARATOR, 1)[1]
+
+    def load(self, entries):
+        """Replace the contents with (name, score) pairs
+
+        The new rankings are built before the swap, so searches keep using
+        the old index and its cache until the new ones replace both at once.
+        """
+        scores = {self._key(name): score or 0 for name, score in entries}
+        keys = sorted(scores)
+
+        prefixes = set()
+        for key in keys:
+            lowered = key.split(SEPARATOR, 1)[0]
+            prefixes.update(lowered[:length] for length in range(1, min(len(lowered), self.PRECOMPUTED_LENGTH) + 1))
+        with self._lock:
+            # Longer prefixes that were in use stay warm across the reload
+            prefixes.update(self._top_cache)
+
+        top_cache = {}
+        for prefix in prefixes:
+            lo = bisect_left(keys, prefix)
+            hi = bisect_left(keys, prefix + '\uffff', lo)
+            if hi - lo > self.SCAN_LIMIT:
+                top_cache[prefix] = self._best(keys[lo:hi], self.cache_depth, scores)
+
+        with self._lock:
+            self._keys = keys
+            self._scores = scores
+            self._top_cache = top_cache
+            self.loaded = True
+
+    def add(self, name, score=0):
+        """Insert a name or update its score"""
+        key = self._key(name)
+        with self._lock:
+            old_score = self._scores.get(key)
+            if old_score is None:
+                insort(self._keys, key)
+            self._scores[key] = score or 0
+            self._update_cached_prefixes(key, old_score)
+
+    def _update_cached_prefixes(self, key, old_score):
+        lowered = key.split(SEPARATOR, 1)[0]
+        for length in range(1, len(lowered) + 1):
+            prefix = lowered[:length]
+            cached = self._top_cache.get(prefix)
+            if cached is None:
+                continue
+            if old_score is not None and key in cached and self._scores[key] < old_score:
+                rest = [k for k in cached if k != key]
+                if key == cached[-1] or self._rank(key) < self._rank(rest[-1]):
+                    # Something outside the cache may now beat it; keep only the
+                    # entries still known to be ahead of everything else
+                    self._top_cache[prefix] = rest
+                    continue
+            candidates = set(cached)
+            candidates.add(key)
+            self._top_cache[prefix] = self._best(candidates, len(cached))
+
+    def _rank(self, key):
+        return (self._scores[key], key)
+
+    def _best(self, keys, limit, scores=None):
+        scores = self._scores if scores is None else scores
+        return heapq.nlargest(limit, keys, key=lambda k: (scores[k], k))
+
+    def search(self, prefix, limit=None):
+        """Up to `limit` (name, score) pairs starting with `prefix`, best first"""
+        limit = limit or self.top_k
+        prefix = prefix.lower()
+        if not prefix or SEPARATOR in prefix:
+            return []
+
+        with self._lock:
+            lo = bisect_left(self._keys, prefix)
+            hi = bisect_left(self._keys, prefix + '\uffff', lo)
+            if hi - lo <= self.SCAN_LIMIT:
+                best = self._best(self._keys[lo:hi], limit)
+            else:
+                cached = self._top_cache.get(prefix)
+                if cached is None or len(cached) < limit:
+                    cached = self._best(self._keys[lo:hi], max(limit, self.cache_depth))
+                    self._top_cache[prefix] = cached
+                best = cached[:limit]
+            return [(self._name(key), self._scores[key]) for key in best]
+
+    def __len__(self):
+        return len(self._keys)
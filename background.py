@@ -0,0 +1,63 @@
+"""
+Background task helpers for FemboyWorld.
+Small thread-based workers that run inside each web worker process.
+"""
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """Run a function every `interval` seconds on a daemon thread"""
+
+    def __init__(self, name, interval, func, run_immediately=False):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.run_immediately = run_immediately
+        self._thread = None
+        self._pid = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def is_running(self):
+        """True if the worker thread is alive in the current process"""
+        return (
+            self._thread is not None
+            and self._pid == os.getpid()
+            and self._thread.is_alive()
+        )
+
+    def ensure_started(self):
+        """Start the worker thread lazily (and again after a fork)"""
+        if self.is_running():
+            return
+        with self._lock:
+            if self.is_running():
+                return
+            self._stop_event = threading.Event()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        if self.run_immediately:
+            self.run_once()
+        while not self._stop_event.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Run the task in the calling thread, logging any failure"""
+        try:
+            return self.func()
+        except Exception:
+            logger.exception('Background task %s failed', self.name)
+
+    def stop(self, timeout=5):
+        """Stop the worker thread and wait for it to exit"""
+        self._stop_event.set()
+        if self.is_running() and threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
@@ -0,0 +1,159 @@
+"""
+Concurrent like benchmark for FemboyWorld's SQLite setup.
+Each profile gets a fresh SQLite file; several processes (like gunicorn
+workers) with several threads each then toggle likes on a handful of hot
+posts through the real /like route, and the request latencies are
+reported per profile.
+
+    python bench_likes.py --processes 4 --threads 8 --likes 50
+
+Profiles: 'default' (SQLite's own defaults: rollback journal, full sync,
+no busy timeout beyond the driver's), 'tuned' (the SQLite profile) and
+'tuned+queue' (profile plus SQLITE_WRITE_QUEUE group commits).
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PROFILES = {
+    'default': {'SQLITE_TUNING': 'false', 'SQLITE_WRITE_QUEUE': 'false'},
+    'tuned': {'SQLITE_TUNING': 'true', 'SQLITE_WRITE_QUEUE': 'false'},
+    'tuned+queue': {'SQLITE_TUNING': 'true', 'SQLITE_WRITE_QUEUE': 'true'},
+}
+HOT_POSTS = 5
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_clients(user_ids, likes, results):
+    """One worker process: a thread per user, each sending `likes` requests.
+
+    Puts a single (latencies, errors) for the whole process on `results`.
+    """
+    latencies, errors = [], []
+
+    def client(user_id):
+        with app.test_client() as c:
+            with c.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            for i in range(likes):
+                started = time.perf_counter()
+                response = c.post(f'/like/{i % HOT_POSTS + 1}')
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    try:
+        from app import app, db
+
+        with app.app_context():
+            db.engine.dispose(close=False)  # connections inherited from the parent stay with it
+        threads = [threading.Thread(target=client, args=(user_id,)) for user_id in user_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        results.put((latencies, len(errors) + (len(user_ids) * likes - len(latencies))))
+
+
+def run_profile(processes, threads, likes):
+    """Benchmark the profile configured in the environment; prints a JSON summary"""
+    from app import app, db, User, Post
+
+    with app.app_context():
+        db.create_all()
+        users = [User(username=f'bench{i}', email=f'bench{i}@example.com', password_hash='x', tos_accepted=True)
+                 for i in range(processes * threads)]
+        db.session.add_all(users)
+        db.session.flush()
+        db.session.add_all([Post(title=f'post {i}', media_path='bench.jpg', media_type='image', user_id=users[0].id, like_count=0)
+                            for i in range(HOT_POSTS)])
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        journal_mode = db.session.execute(db.text('PRAGMA journal_mode')).scalar()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [
+        context.Process(target=run_clients, args=(user_ids[i * threads:(i + 1) * threads], likes, results))
+        for i in range(processes)
+    ]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    latencies, errors = [], 0
+    for _ in workers:
+        worker_latencies, worker_errors = results.get()
+        latencies += worker_latencies
+        errors += worker_errors
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        'journal_mode': journal_mode,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=4, help='worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients per process')
+    parser.add_argument('--likes', type=int, default=50, help='requests per client')
+    parser.add_argument('--profile', choices=PROFILES, action='append', help='profiles to run (default: all)')
+    parser.add_argument('--run', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_profile(args.processes, args.threads, args.likes)
+        return
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f'{args.processes} processes x {args.threads} clients x {args.likes} likes')
+    print(f'{"profile":<12} {"journal":>8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8} {"errors":>7}')
+    for name in args.profile or PROFILES:
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(
+                os.environ,
+                FLASK_ENV='production',
+                SESSION_COOKIE_SECURE='false',
+                DATABASE_URL=f'sqlite:///{os.path.join(workdir, "bench.db")}',
+                PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')])),
+                **PROFILES[name]
+            )
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--run',
+                 '--processes', str(args.processes), '--threads', str(args.threads), '--likes', str(args.likes)],
+                cwd=workdir, env=env, capture_output=True, text=True
+            )
+            if output.returncode != 0:
+                print(f'{name:<12} failed:\n{output.stderr}')
+                continue
+            result = json.loads(output.stdout.strip().splitlines()[-1])
+            print(f'{name:<12} {result["journal_mode"]:>8} {result["throughput"]:>8.0f} {result["p50_ms"]:>8.1f} '
+                  f'{result["p95_ms"]:>8.1f} {result["p99_ms"]:>8.1f} {result["max_ms"]:>8.1f} {result["errors"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
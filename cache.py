@@ -0,0 +1,100 @@
+"""
+In-process caches for FemboyWorld.
+Each worker keeps its own copy, so entries carry a TTL that bounds how
+long a worker can serve data another worker has already changed.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry.
+
+    With `max_bytes`, callers pass each entry's approximate size to set()
+    and the least recently used entries are evicted to stay under it.
+    """
+
+    def __init__(self, max_entries=10000, ttl=60, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()  # key -> (expires_at, value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_entries > 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value, size = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self._bytes -= size
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, size=0):
+        if not self.enabled:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return  # would evict everything else
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (expires_at, value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._bytes -= item[2]
+
+    def delete_where(self, predicate):
+        """Drop every entry whose key matches; returns how many were dropped"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._bytes -= self._data.pop(key)[2]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
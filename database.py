@@ -0,0 +1,432 @@
+"""
+Database engine tuning for FemboyWorld.
+SQLite has a single writer, so every gunicorn worker's likes, view counts
+and notifications queue on one lock. The SQLite profile sets WAL (readers
+no longer block the writer), synchronous=NORMAL, a busy timeout and larger
+page/mmap caches on every new connection. WriteQueue optionally funnels a
+worker's small writes through one thread that group-commits them.
+On client/server databases (Postgres) the connection pool is sized from
+the gunicorn worker and thread counts and records how long requests wait
+for a connection. With REPLICA_DATABASE_URL set, ReplicaRouter sends the
+reads of GET requests to a replica while it is caught up.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from background import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+def sqlite_pragmas(config):
+    """PRAGMA name -> value for new SQLite connections, from the app config"""
+    if not config.get('SQLITE_TUNING', True):
+        return {}
+    return {
+        'journal_mode': config.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': config.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(config.get('SQLITE_BUSY_TIMEOUT', 5.0) * 1000),
+        'mmap_size': config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        'cache_size': -config.get('SQLITE_CACHE_SIZE', 64 * 1024),  # negative = KiB rather than pages
+    }
+
+
+def apply_sqlite_profile(engine, pragmas):
+    """Run the PRAGMAs on each new connection of a SQLite engine"""
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return False
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    return True
+
+
+def pool_size_for(config):
+    """Connections per worker process: one per request thread plus background threads.
+
+    Capped so that every worker's pool and overflow together stay within
+    DB_MAX_CONNECTIONS on the server.
+    """
+    if config.get('DB_POOL_SIZE'):
+        return config['DB_POOL_SIZE']
+    workers = max(config.get('WEB_CONCURRENCY', 1), 1)
+    wanted = config.get('WEB_THREADS', 1) + config.get('DB_POOL_BACKGROUND_THREADS', 2)
+    budget = config.get('DB_MAX_CONNECTIONS', 100) // workers - config.get('DB_MAX_OVERFLOW', 5)
+    if budget < wanted:
+        logger.warning(
+            'DB_MAX_CONNECTIONS allows %d pooled connections per worker, %d wanted; requests may wait for connections',
+            max(budget, 1), wanted
+        )
+    return max(min(wanted, budget), 1)
+
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database URL.
+
+    SQLite keeps Flask-SQLAlchemy's defaults (its profile is applied per
+    connection instead); other databases get a monitored, sized pool.
+    """
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite':
+        return {}
+
+    options = {
+        'poolclass': MonitoredQueuePool,
+        'pool_size': pool_size_for(config),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 5),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+    }
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT', 30)
+    if statement_timeout and url.get_backend_name() == 'postgresql':
+        options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout * 1000)}'}
+    return options
+
+
+class MonitoredQueuePool(QueuePool):
+    """QueuePool that records how long checkouts wait for a free connection"""
+
+    SLOW_CHECKOUT = 0.1  # seconds
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.slow_checkouts = 0
+        self.timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+                if waited >= self.SLOW_CHECKOUT:
+                    self.slow_checkouts += 1
+
+
+def pool_stats(engine):
+    """Pool occupancy (and checkout waits, for MonitoredQueuePool) of this worker"""
+    pool = engine.pool
+    stats = {'class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            saturation=pool.checkedout() / capacity if capacity else None,
+        )
+    if isinstance(pool, MonitoredQueuePool):
+        stats.update(
+            checkouts=pool.checkouts,
+            avg_wait_ms=pool.wait_time / pool.checkouts * 1000 if pool.checkouts else 0.0,
+            max_wait_ms=pool.max_wait * 1000,
+            slow_checkouts=pool.slow_checkouts,
+            timeouts=pool.timeouts,
+        )
+    return stats
+
+
+def insert_ignore(table, rows, executor):
+    """Multi-row INSERT that skips rows violating a unique constraint.
+
+    `executor` is a Connection or a Session; with a Session the statement
+    is part of its transaction.
+    """
+    bind = executor.get_bind() if hasattr(executor, 'get_bind') else executor
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table).values(rows).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(table).values(rows).on_conflict_do_nothing()
+    else:
+        statement = insert(table).values(rows).prefix_with('IGNORE')
+    return executor.execute(statement)
+
+
+class _Write:
+    __slots__ = ('func', 'future')
+
+    def __init__(self, func):
+        self.func = func
+        self.future = Future()
+
+
+class WriteQueue:
+    """Run small write transactions on one thread, several per commit.
+
+    execute(func) calls func(connection) inside a transaction and returns
+    its result once that transaction has committed. With SQLITE_WRITE_QUEUE
+    on, writes arriving within SQLITE_WRITE_BATCH_WINDOW of each other
+    share a transaction (each in its own SAVEPOINT, so one failure does not
+    undo the rest) and the worker takes the write lock once per batch.
+    Otherwise func runs in the calling thread in its own transaction.
+    """
+
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = None
+        self.enabled = False
+        self._queue = queue.Queue()
+        self._task = None
+
+        # Counters
+        self.writes = 0
+        self.failed_writes = 0
+        self.batches = 0
+        self.failed_batches = 0
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        self.enabled = app.config.get('SQLITE_WRITE_QUEUE', False)
+        self.batch_window = app.config.get('SQLITE_WRITE_BATCH_WINDOW', 0.002)
+        self.batch_size = app.config.get('SQLITE_WRITE_BATCH_SIZE', 100)
+        self.timeout = app.config.get('SQLITE_WRITE_TIMEOUT', 30)
+        # interval 0: the task loops on its own, blocking in _take_batch
+        self._task = PeriodicTask('sqlite-writer', 0, self.run_batch)
+        atexit.register(self.shutdown)
+
+    def execute(self, func):
+        """func(connection) in a committed transaction; returns its result"""
+        if not self.enabled:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    return func(conn)
+
+        write = _Write(func)
+        self._queue.put(write)
+        self._task.ensure_started()
+        return write.future.result(self.timeout)
+
+    def _take_batch(self):
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run_batch(self):
+        """Commit the next batch of queued writes (runs on the writer thread)"""
+        batch = self._take_batch()
+        if not batch:
+            return
+        results = []
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    if conn.dialect.name == 'sqlite':
+                        # Take the write lock up front; upgrading a read lock later fails without waiting
+                        conn.exec_driver_sql('BEGIN IMMEDIATE')
+                    for write in batch:
+                        savepoint = conn.begin_nested()
+                        try:
+                            results.append((write, write.func(conn), None))
+                            savepoint.commit()
+                        except Exception as exc:
+                            savepoint.rollback()
+                            results.append((write, None, exc))
+        except Exception as exc:
+            self.failed_batches += 1
+            self.failed_writes += len(batch)
+            logger.exception('Failed to commit %d queued writes', len(batch))
+            for write in batch:
+                write.future.set_exception(exc)
+            return
+
+        self.batches += 1
+        for write, result, exc in results:
+            if exc is not None:
+                self.failed_writes += 1
+                write.future.set_exception(exc)
+            else:
+                self.writes += 1
+                write.future.set_result(result)
+
+    def shutdown(self):
+        """Stop the writer and commit whatever is still queued"""
+        if self._task is not None:
+            self._task.stop()
+            while not self._queue.empty():
+                self.run_batch()
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'queued': self._queue.qsize(),
+            'writes': self.writes,
+            'failed_writes': self.failed_writes,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+        }
+
+
+class RoutingSession(Session):
+    """db.session that reads from the replica when the request was routed there.
+
+    Writes (flushes and DML statements) always go to the primary, and pin
+    the rest of the request to it so it reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and g.get('_read_replica'):
+            if self._flushing or getattr(clause, 'is_dml', False):
+                g._read_replica = False
+            else:
+                return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    """Route GET requests to the 'replica' bind while its lag is acceptable.
+
+    A background check writes a heartbeat row on the primary and reads it
+    back from the replica; the difference is the lag. After a write
+    request the client's session sticks to the primary for
+    REPLICA_STICKY_SECONDS, so a redirect after POST sees its own change.
+    """
+
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, app=None, db=None, table=None):
+        self.app = None
+        self.db = None
+        self.table = None
+        self.enabled = False
+        self.lag = None
+        self.healthy = False
+        self._task = None
+
+        # Counters
+        self.replica_requests = 0
+        self.primary_requests = 0
+        self.sticky_requests = 0
+        self.lagging_requests = 0
+
+        if app is not None:
+            self.init_app(app, db, table)
+
+    def init_app(self, app, db, table):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.enabled = 'replica' in app.config.get('SQLALCHEMY_BINDS', {})
+        self.max_lag = app.config.get('REPLICA_MAX_LAG', 10)
+        self.sticky_seconds = app.config.get('REPLICA_STICKY_SECONDS', 10)
+        if not self.enabled:
+            return
+        self._task = PeriodicTask(
+            'replica-lag-check',
+            app.config.get('REPLICA_CHECK_INTERVAL', 2),
+            self.check,
+            run_immediately=True
+        )
+        app.before_request(self._route)
+        app.after_request(self._stick_after_write)
+
+    def check(self):
+        """Measure the replica's lag; an unreachable replica counts as lagging"""
+        now = datetime.utcnow()
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    if not conn.execute(self.table.update().where(self.table.c.id == 1).values(written_at=now)).rowcount:
+                        conn.execute(self.table.insert().values(id=1, written_at=now))
+                with self.db.engines['replica'].connect() as conn:
+                    seen = conn.execute(self.db.select(self.table.c.written_at).where(self.table.c.id == 1)).scalar()
+        except Exception:
+            if self.healthy:
+                logger.warning('Replica check failed, reading from the primary', exc_info=True)
+            self.lag, self.healthy = None, False
+            return
+
+        # An upper bound: includes the time since the last heartbeat the replica received
+        self.lag = (now - seen).total_seconds() if seen else None
+        healthy = self.lag is not None and self.lag <= self.max_lag
+        if healthy and not self.healthy:
+            logger.info('Replica caught up (lag %s s)', self.lag)
+        elif self.healthy and not healthy:
+            logger.warning('Replica lagging, reading from the primary (lag %s s)', self.lag)
+        self.healthy = healthy
+
+    def _route(self):
+        self._task.ensure_started()
+        if request.method not in self.SAFE_METHODS:
+            self.primary_requests += 1
+        elif session.get('_primary_until', 0) > time.time():
+            self.sticky_requests += 1
+        elif not self.healthy:
+            self.lagging_requests += 1
+        else:
+            self.replica_requests += 1
+            g._read_replica = True
+
+    def use_primary(self, stick=False):
+        """Send the rest of this request to the primary.
+
+        With `stick`, the client's next requests go there too for
+        REPLICA_STICKY_SECONDS, as after a write request.
+        """
+        g._read_replica = False
+        if stick and self.enabled:
+            session['_primary_until'] = time.time() + self.sticky_seconds
+
+    def _stick_after_write(self, response):
+        if request.method not in self.SAFE_METHODS and response.status_code < 400:
+            session['_primary_until'] = time.time() + self.sticky_seconds
+        return response
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'healthy': self.healthy,
+            'lag': self.lag,
+            'replica_requests': self.replica_requests,
+            'primary_requests': self.primary_requests,
+            'sticky_requests': self.sticky_requests,
+            'lagging_requests': self.lagging_requests,
+        }
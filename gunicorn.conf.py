@@ -0,0 +1,33 @@
+"""
+gunicorn settings for FemboyWorld (read from the working directory, so
+`gunicorn app:app` picks them up).
+Every live notification stream holds a worker thread for up to
+LIVE_STREAM_TIMEOUT, so threaded workers get LIVE_MAX_CONNECTIONS threads
+for streams on top of the WEB_THREADS that serve ordinary requests. Async
+workers (WEB_WORKER_CLASS=gevent) run streams on greenlets instead.
+"""
+
+import os
+
+import config as app_config
+
+# Named so it doesn't shadow gunicorn's own `config` setting
+settings = app_config.config[os.environ.get('FLASK_ENV', 'development')]
+
+# gunicorn worker classes that serve one request per thread
+THREADED_WORKER_CLASSES = ('sync', 'gthread')
+
+workers = settings.WEB_CONCURRENCY
+worker_class = settings.WEB_WORKER_CLASS
+threads = settings.WEB_THREADS + settings.LIVE_MAX_CONNECTIONS
+
+
+def on_starting(server):
+    """Refuse to start when live streams could occupy every thread of a worker"""
+    needed = settings.WEB_THREADS + settings.LIVE_MAX_CONNECTIONS
+    if server.cfg.worker_class_str in THREADED_WORKER_CLASSES and server.cfg.threads < needed:
+        raise RuntimeError(
+            f'{server.cfg.threads} threads per worker cannot serve {settings.LIVE_MAX_CONNECTIONS} live streams '
+            f'(LIVE_MAX_CONNECTIONS) plus {settings.WEB_THREADS} requests (WEB_THREADS); '
+            f'run with --threads {needed} or lower LIVE_MAX_CONNECTIONS'
+        )
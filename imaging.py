@@ -0,0 +1,260 @@
+"""
+Image derivatives for FemboyWorld uploads.
+Each uploaded image gets a thumbnail and a feed-size copy, in the source
+format family (JPEG, or PNG when it has transparency) and in WebP. EXIF
+and other metadata are dropped from the derivatives and from the original
+(after applying its orientation). The cleaned original is a new file, so
+content-addressed posts move to its blob; stored files never change.
+Resizing runs in a process pool so the upload request returns as soon as
+the file is saved; the results are written to Post.variants / width /
+height (and media_path) when they come back.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from media_store import MediaStore, blob_digest
+
+logger = logging.getLogger(__name__)
+
+# name -> longest edge in pixels
+SIZES = {
+    'thumb': 320,
+    'feed': 1080,
+}
+VARIANT_DIR = 'variants'
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+
+def _strip_original(image, path):
+    """Save the original to `path` without metadata, upright.
+
+    Returns (upright image, whether `path` was written).
+    """
+    from PIL import ImageOps
+
+    fmt = image.format
+    if fmt == 'MPO':
+        # Most phone JPEGs: the primary image plus embedded previews; keep the primary
+        image.seek(0)
+    elif fmt not in ('JPEG', 'PNG'):
+        return image.copy(), False  # GIFs carry no EXIF worth stripping, and re-encoding would lose animation
+    orientation = image.getexif().get(0x0112, 1)
+    upright = ImageOps.exif_transpose(image)
+    # Only the colour profile is carried over
+    icc_profile = image.info.get('icc_profile')
+    if fmt in ('JPEG', 'MPO'):
+        if orientation == 1 and fmt == 'JPEG':
+            # Same quantization tables as the upload, so no visible loss
+            image.save(path, 'JPEG', quality='keep', optimize=True, icc_profile=icc_profile)
+        else:
+            upright.save(path, 'JPEG', quality=95, optimize=True, icc_profile=icc_profile)
+    else:
+        upright.save(path, 'PNG', optimize=True, icc_profile=icc_profile)
+    return upright, True
+
+
+def generate_variants(upload_folder, media_path):
+    """Create the derivatives of one upload; runs in a pool worker.
+
+    Returns {'width', 'height', 'variants': {name: relative path}}, plus
+    'media_path' when the cleaned original was stored as a new blob. Paths
+    are relative to the upload folder.
+    """
+    from PIL import Image
+
+    store = MediaStore(upload_folder)
+    source = store.path(media_path)
+    output_dir = os.path.join(upload_folder, VARIANT_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    result = {}
+
+    fd, stripped = tempfile.mkstemp(dir=upload_folder, prefix='.stripped-')
+    os.close(fd)
+    try:
+        with Image.open(source) as original:
+            original.load()
+            # MPO's extra frames are previews / stereo views, not animation
+            animated = getattr(original, 'n_frames', 1) > 1 and original.format != 'MPO'
+            icc_profile = original.info.get('icc_profile')
+            image, rewritten = _strip_original(original, stripped)
+
+        if rewritten and blob_digest(media_path):
+            result['media_path'], _ = store.save_file(stripped, media_path.rsplit('.', 1)[-1])
+        elif rewritten:
+            os.replace(stripped, source)  # legacy flat upload, cleaned in place
+    finally:
+        if os.path.exists(stripped):
+            os.unlink(stripped)
+
+    stem = os.path.splitext(os.path.basename(result.get('media_path', media_path)))[0]
+    width, height = image.size
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    ext, fmt, options = ('png', 'PNG', {'optimize': True}) if has_alpha else \
+        ('jpg', 'JPEG', {'quality': JPEG_QUALITY, 'optimize': True, 'progressive': True})
+
+    variants = {}
+    for name, edge in SIZES.items():
+        if animated and name != 'thumb':
+            continue  # a still feed copy would lose the animation; serve the original
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)  # never upscales
+
+        path = f'{VARIANT_DIR}/{stem}_{name}.{ext}'
+        resized.save(os.path.join(upload_folder, path), fmt, icc_profile=icc_profile, **options)
+        variants[name] = path
+
+        webp_path = f'{VARIANT_DIR}/{stem}_{name}.webp'
+        resized.save(os.path.join(upload_folder, webp_path), 'WEBP', quality=WEBP_QUALITY, method=4, icc_profile=icc_profile)
+        variants[f'{name}_webp'] = webp_path
+
+    result.update(width=width, height=height, variants=variants)
+    return result
+
+
+class MediaProcessor:
+    """Runs a per-upload job in a process pool and records its result on the post.
+
+    `job(upload_folder, media_path)` returns the column values to store,
+    e.g. generate_variants for images or video.process_video.
+    """
+
+    def __init__(self, app=None, db=None, table=None, job=generate_variants, workers_setting='IMAGE_WORKERS'):
+        self.app = None
+        self.db = None
+        self.table = None
+        self.job = job
+        self.workers_setting = workers_setting
+        self.workers = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._listeners = []
+
+        # Counters
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+
+        if app is not None:
+            self.init_app(app, db, table)
+
+    def init_app(self, app, db, table):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.workers = app.config.get(self.workers_setting, 2)
+        atexit.register(self.shutdown)
+
+    def on_media_moved(self, callback):
+        """Register callback(connection, old_path, new_path), run when a post moves to its cleaned blob"""
+        self._listeners.append(callback)
+        return callback
+
+    def _pool(self):
+        """The process pool, created lazily (and again after a fork)"""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # spawn, not fork: forking a threaded web worker can deadlock
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context('spawn')
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def submit(self, post_id, media_path):
+        """Queue an upload for processing; inline when the pool has 0 workers"""
+        self.submitted += 1
+        upload_folder = self.app.config['UPLOAD_FOLDER']
+        if self.workers <= 0:
+            try:
+                result = self.job(upload_folder, media_path)
+            except Exception:
+                self._failed(post_id)
+                return
+            self.store(post_id, result)
+            return
+
+        future = self._pool().submit(self.job, upload_folder, media_path)
+        future.add_done_callback(lambda done: self._finished(post_id, done))
+
+    def _finished(self, post_id, future):
+        try:
+            result = future.result()
+        except Exception:
+            self._failed(post_id)
+            return
+        self.store(post_id, result)
+
+    def _failed(self, post_id):
+        self.failed += 1
+        logger.exception('%s failed for post %s', self.job.__name__, post_id)
+
+    def store(self, post_id, result):
+        """Record a job's result on the post (which keeps serving its original until then)"""
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    old_path = conn.execute(
+                        self.db.select(self.table.c.media_path).where(self.table.c.id == post_id)
+                    ).scalar()
+                    conn.execute(
+                        self.table.update().where(self.table.c.id == post_id).values(**result)
+                    )
+                    new_path = result.get('media_path')
+                    if new_path and old_path and new_path != old_path:
+                        for callback in self._listeners:
+                            callback(conn, old_path, new_path)
+        except Exception:
+            self._failed(post_id)
+            return False
+        self.processed += 1
+        return True
+
+    def process_many(self, posts):
+        """Process (post_id, media_path) pairs and wait for them, for backfills.
+
+        Yields (post_id, ok) in order as each one finishes.
+        """
+        upload_folder = self.app.config['UPLOAD_FOLDER']
+        if self.workers <= 0:
+            results = ((post_id, lambda path=media_path: self.job(upload_folder, path)) for post_id, media_path in posts)
+        else:
+            futures = [
+                (post_id, self._pool().submit(self.job, upload_folder, media_path))
+                for post_id, media_path in posts
+            ]
+            results = ((post_id, future.result) for post_id, future in futures)
+
+        for post_id, get_result in results:
+            try:
+                result = get_result()
+            except Exception:
+                self._failed(post_id)
+                yield post_id, False
+                continue
+            yield post_id, self.store(post_id, result)
+
+    def shutdown(self):
+        """Let queued uploads finish before the worker exits"""
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._pid = None
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'submitted': self.submitted,
+            'processed': self.processed,
+            'failed': self.failed,
+        }
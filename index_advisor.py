@@ -0,0 +1,121 @@
+"""
+Index advisor for FemboyWorld.
+Replays the app's read routes through the test client, records the
+SELECTs each one runs and asks the database for their plans: EXPLAIN
+QUERY PLAN on SQLite, EXPLAIN on Postgres (with sequential scans turned
+off, so a Seq Scan that remains means no index can serve the query, not
+just that the table is small). Full table scans and sorts that no index
+provides are reported per route, with the statement that caused them.
+Any INSERT, UPDATE or DELETE a route makes is reported too, since the
+routes run against the configured database.
+"""
+
+import re
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import event, text
+
+POSTGRES_SEQ_SCAN = re.compile(r'Seq Scan on (\S+)')
+POSTGRES_SORT = re.compile(r'^\s*(?:->\s*)?(?:Incremental )?Sort ')
+
+
+def plan_findings(dialect, lines):
+    """(kind, table or None, plan line) for each problem in an EXPLAIN output"""
+    findings = []
+    for line in lines:
+        if dialect == 'sqlite':
+            detail = line.strip()
+            if detail.startswith('SCAN ') and ' USING ' not in detail and 'VIRTUAL TABLE' not in detail \
+                    and 'CONSTANT ROW' not in detail and '(' not in detail:
+                findings.append(('full scan', detail.split()[1], detail))
+            elif detail.startswith('USE TEMP B-TREE FOR ORDER BY'):
+                findings.append(('sort', None, detail))
+        elif dialect == 'postgresql':
+            match = POSTGRES_SEQ_SCAN.search(line)
+            if match:
+                findings.append(('full scan', match.group(1), line.strip()))
+            elif POSTGRES_SORT.match(line):
+                findings.append(('sort', None, line.strip()))
+    return findings
+
+
+class IndexAdvisor:
+    """Collect the queries behind routes and flag plans that scan or sort whole tables"""
+
+    def __init__(self, app, db):
+        self.app = app
+        self.db = db
+
+    @contextmanager
+    def capture(self):
+        """Record (engine, statement, parameters) of every single-row-set SELECT in the block.
+
+        Yields (queries, writes); `writes` collects the statements that change data.
+        Only this thread's statements count: engine events fire for every
+        thread, including background tasks and the write queue.
+        """
+        queries = []
+        writes = []
+        thread_id = threading.get_ident()
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if threading.get_ident() != thread_id:
+                return
+            verb = statement.lstrip().upper()
+            if not executemany and verb.startswith(('SELECT', 'WITH')):
+                queries.append((conn.engine, statement, parameters))
+            elif verb.startswith(('INSERT', 'UPDATE', 'DELETE')):
+                writes.append(statement)
+
+        engines = set(self.db.engines.values())
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', record)
+        try:
+            yield queries, writes
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', record)
+
+    def explain(self, engine, statement, parameters):
+        """The plan of one captured statement, as text lines"""
+        with engine.connect() as conn:
+            if engine.dialect.name == 'sqlite':
+                rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).all()
+                return [row[-1] for row in rows]
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text('SET LOCAL enable_seqscan = off'))
+                return [row[0] for row in conn.exec_driver_sql(f'EXPLAIN {statement}', parameters).all()]
+            return []
+
+    def run(self, paths, user_id=None, reset=None):
+        """Request each path and explain its queries.
+
+        Returns [{'path', 'status', 'queries', 'writes', 'findings': [(kind, table, plan line, statement)]}].
+        `reset` is called before each request, e.g. to clear caches that
+        would otherwise answer without touching the database.
+        """
+        report = []
+        with self.app.test_client() as client:
+            if user_id is not None:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+            for path in paths:
+                if reset is not None:
+                    reset()
+                with self.capture() as (queries, writes):
+                    status = client.get(path).status_code
+
+                findings = []
+                seen = set()
+                for engine, statement, parameters in queries:
+                    if statement in seen:
+                        continue
+                    seen.add(statement)
+                    for kind, table, line in plan_findings(engine.dialect.name, self.explain(engine, statement, parameters)):
+                        findings.append((kind, table, line, statement))
+                report.append({
+                    'path': path, 'status': status, 'queries': len(queries), 'writes': writes, 'findings': findings
+                })
+        return report
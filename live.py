@@ -0,0 +1,315 @@
+"""
+Live notifications over Server-Sent Events.
+Each worker keeps a broker of its connected users. Notifications are
+published to it once their batch is committed. An optional broadcast
+backend forwards them to the brokers of the other gunicorn workers:
+'socket' (Unix datagram sockets, same host) or 'redis' (pub/sub).
+Event ids are notification ids, so a reconnecting client resumes from
+Last-Event-ID by replaying what it missed from the database.
+
+A stream occupies its worker thread for up to LIVE_STREAM_TIMEOUT, so a
+worker accepts at most LIVE_MAX_CONNECTIONS streams; gunicorn.conf.py
+gives threaded workers that many threads on top of WEB_THREADS.
+"""
+
+import glob
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+def make_event(row):
+    """JSON-safe event payload for a notification row or model"""
+    get = row.get if isinstance(row, dict) else lambda field: getattr(row, field)
+    created_at = get('created_at')
+    return {
+        'id': get('id'),
+        'type': get('type'),
+        'title': get('title'),
+        'message': get('message'),
+        'related_id': get('related_id'),
+        'created_at': created_at.isoformat() if hasattr(created_at, 'isoformat') else created_at,
+    }
+
+
+def format_event(event):
+    lines = []
+    if event.get('id') is not None:
+        lines.append(f'id: {event["id"]}')
+    lines.append('event: notification')
+    lines.append(f'data: {json.dumps(event)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """One open stream; events are queued here by the broker"""
+
+    def __init__(self, user_id, max_queued=100):
+        self.user_id = user_id
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=max_queued)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # The client is not keeping up; end the stream so it reconnects
+            # and replays from the database with Last-Event-ID
+            self.overflowed = True
+
+    def get(self, timeout):
+        return self._queue.get(timeout=timeout)
+
+
+class EventBroker:
+    """In-process pub/sub of notification events keyed by recipient"""
+
+    def __init__(self, max_connections=100, max_queued=100):
+        self.max_connections = max_connections
+        self.max_queued = max_queued
+        self.broadcast = None
+        self._subscribers = {}  # user_id -> set of Subscription
+        self._count = 0
+        self._lock = threading.Lock()
+
+        # Counters
+        self.published = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.overflows = 0
+
+    def subscribe(self, user_id):
+        """Open a subscription, or None if this worker is at its connection limit"""
+        if self.broadcast is not None:
+            self.broadcast.ensure_started()
+        with self._lock:
+            if self._count >= self.max_connections:
+                self.rejected += 1
+                return None
+            subscription = Subscription(user_id, self.max_queued)
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Close a subscription (safe to call more than once)"""
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if not subscriptions or subscription not in subscriptions:
+                return
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscribers[subscription.user_id]
+            self._count -= 1
+
+    def publish_many(self, events):
+        """Publish (user_id, event) pairs here and to the other workers"""
+        if not events:
+            return
+        self.published += len(events)
+        self.deliver_many(events)
+        if self.broadcast is not None:
+            try:
+                self.broadcast.send(events)
+            except Exception:
+                logger.exception('Failed to broadcast %d live notifications', len(events))
+
+    def deliver_many(self, events):
+        """Hand events to this worker's subscribers only"""
+        with self._lock:
+            targets = [(list(self._subscribers.get(user_id, ())), event) for user_id, event in events]
+        for subscriptions, event in targets:
+            for subscription in subscriptions:
+                was_overflowed = subscription.overflowed
+                subscription.put(event)
+                if subscription.overflowed and not was_overflowed:
+                    self.overflows += 1
+                else:
+                    self.delivered += 1
+
+    def stream(self, subscription, backlog=(), heartbeat=15, timeout=600):
+        """Yield SSE text: the replayed backlog, then live events and heartbeats.
+
+        The stream ends after `timeout` seconds (the client reconnects with
+        Last-Event-ID) so long-lived connections are spread across workers.
+        """
+        try:
+            yield 'retry: 3000\n\n'
+            # Only the replayed ids are skipped later: ids from different
+            # workers (and Postgres transactions) can arrive out of order
+            replayed = set()
+            for event in backlog:
+                replayed.add(event['id'])
+                yield format_event(event)
+
+            deadline = time.monotonic() + timeout
+            while not subscription.overflowed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = subscription.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if event.get('id') is not None and event['id'] in replayed:
+                    continue  # already sent as part of the backlog
+                yield format_event(event)
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            connections = self._count
+            users = len(self._subscribers)
+        return {
+            'connections': connections,
+            'max_connections': self.max_connections,
+            'users': users,
+            'published': self.published,
+            'delivered': self.delivered,
+            'rejected': self.rejected,
+            'overflows': self.overflows,
+            'broadcast': self.broadcast.name if self.broadcast is not None else None,
+        }
+
+
+class Broadcast(ABC):
+    """Forwards published events to the brokers of other workers"""
+
+    name = None
+    CHUNK_SIZE = 100  # events per message
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start listening in this process (again after a fork)"""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._start()
+                self._pid = os.getpid()
+
+    @abstractmethod
+    def _start(self):
+        """Start receiving the other workers' messages in this process"""
+
+    def send(self, events):
+        for start in range(0, len(events), self.CHUNK_SIZE):
+            chunk = events[start:start + self.CHUNK_SIZE]
+            self._send(json.dumps({'origin': self.origin, 'events': chunk}).encode())
+
+    @abstractmethod
+    def _send(self, payload):
+        """Deliver one encoded message to the other workers"""
+
+    @property
+    def origin(self):
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _receive(self, payload):
+        message = json.loads(payload)
+        if message.get('origin') == self.origin:
+            return  # already delivered locally
+        self.broker.deliver_many([tuple(item) for item in message['events']])
+
+
+class SocketBroadcast(Broadcast):
+    """One Unix datagram socket per worker in a shared directory (single host)"""
+
+    name = 'socket'
+
+    def __init__(self, broker, directory):
+        super().__init__(broker)
+        self.directory = directory
+        self._sender = None
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.sock')
+
+    def _start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(os.getpid())
+        if os.path.exists(path):
+            os.unlink(path)
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        threading.Thread(target=self._listen, args=(receiver,), name='live-broadcast', daemon=True).start()
+
+    def _listen(self, receiver):
+        while True:
+            try:
+                self._receive(receiver.recv(1 << 20))
+            except Exception:
+                logger.exception('Dropped a malformed live notification message')
+
+    def _send(self, payload):
+        if self._sender is None or self._pid != os.getpid():
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+        own = self._path(os.getpid())
+        for path in glob.glob(os.path.join(self.directory, '*.sock')):
+            if path == own:
+                continue
+            try:
+                self._sender.sendto(payload, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Worker is gone; clean up after it
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                logger.warning('Live notification socket %s is full, dropping message', path)
+
+
+class RedisBroadcast(Broadcast):
+    """Redis pub/sub channel shared by every worker on every host"""
+
+    name = 'redis'
+
+    def __init__(self, broker, client, channel='notifications:live'):
+        super().__init__(broker)
+        self.client = client
+        self.channel = channel
+
+    def _start(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda message: self._receive(message['data'])})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _send(self, payload):
+        self.client.publish(self.channel, payload)
+
+
+def create_event_broker(app):
+    """Broker with the broadcast selected by LIVE_BROADCAST ('none', 'socket' or 'redis')"""
+    broker = EventBroker(
+        max_connections=app.config.get('LIVE_MAX_CONNECTIONS', 100),
+        max_queued=app.config.get('LIVE_MAX_QUEUED', 100)
+    )
+    backend = app.config.get('LIVE_BROADCAST', 'none')
+    if backend == 'socket':
+        broker.broadcast = SocketBroadcast(broker, app.config.get('LIVE_SOCKET_DIR', 'instance/live'))
+    elif backend == 'redis':
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('LIVE_BROADCAST=redis requires the redis package (pip install redis)') from e
+        broker.broadcast = RedisBroadcast(broker, redis.Redis.from_url(app.config['REDIS_URL']))
+    elif backend != 'none':
+        raise ValueError(f'Unknown LIVE_BROADCAST: {backend}')
+    return broker
@@ -0,0 +1,111 @@
+"""
+Content-addressed media storage for FemboyWorld.
+Files are named by the SHA-256 of their bytes as uploaded and sharded two
+levels deep (`ab/cd/abcd....jpg`), so identical re-uploads share one file
+and no directory grows past a few thousand entries. Which posts use a
+blob is tracked by the media_blob table's ref_count.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+READ_SIZE = 64 * 1024
+BLOB_PATH = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})\.\w+$')
+
+
+def blob_path(digest, ext):
+    """Relative path of a blob: 'ab/cd/<digest>.<ext>'"""
+    return f'{digest[:2]}/{digest[2:4]}/{digest}.{ext.lower()}'
+
+
+def blob_digest(path):
+    """The SHA-256 a blob path is named after, or None for legacy paths"""
+    match = BLOB_PATH.match(path or '')
+    return match.group(1) if match else None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class MediaStore:
+    """Sharded, deduplicating file store under one root directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, relative_path):
+        return os.path.join(self.root, *relative_path.split('/'))
+
+    def exists(self, relative_path):
+        return os.path.exists(self.path(relative_path))
+
+    def save_stream(self, stream, ext):
+        """Copy a readable stream into the store, hashing as it goes.
+
+        Returns (relative path, size). Nothing is written if an identical
+        blob is already stored.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for data in iter(lambda: stream.read(READ_SIZE), b''):
+                    digest.update(data)
+                    f.write(data)
+                    size += len(data)
+            return self._place(tmp, digest.hexdigest(), ext), size
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def save_file(self, source, ext, move=True):
+        """Store an existing file, moved by default; otherwise the source is
+        left in place (hard-linked when possible, else copied).
+        Returns (relative path, size).
+        """
+        size = os.path.getsize(source)
+        digest = file_digest(source)
+        if not move:
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.incoming-')
+            os.close(fd)
+            try:
+                os.unlink(tmp)
+                os.link(source, tmp)
+            except OSError:
+                shutil.copyfile(source, tmp)  # e.g. the source is on another filesystem
+            source = tmp
+        try:
+            return self._place(source, digest, ext), size
+        finally:
+            if not move and os.path.exists(source):
+                os.unlink(source)
+
+    def _place(self, source, digest, ext):
+        relative_path = blob_path(digest, ext)
+        target = self.path(relative_path)
+        if os.path.exists(target):
+            os.unlink(source)  # already stored
+            return relative_path
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(source, target)
+        except OSError:
+            shutil.move(source, target)  # e.g. the source is on another filesystem
+        return relative_path
+
+    def delete(self, relative_path):
+        try:
+            os.unlink(self.path(relative_path))
+        except FileNotFoundError:
+            pass
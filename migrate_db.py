@@ -1,203 +1,266 @@
 #!/usr/bin/env python3
 """
 Database Migration Script for FemboyWorld
-This script helps migrate existing databases to include new features.
+Brings any existing database (SQLite or Postgres) up to the current schema.
+Migrations are numbered and recorded in the schema_version table, so the
+script can be run on every deploy; see migrations.py for how steps run.
+
+    python migrate_db.py              # apply pending migrations
+    python migrate_db.py --dry-run    # show what would run
+    python migrate_db.py --status     # list applied migrations
+
+New tables, columns or indexes get a new Migration at the end of
+MIGRATIONS; never edit one that has shipped.
 """
 
-import sqlite3
+import argparse
 import os
 from datetime import datetime
 
-def migrate_database():
-    """Migrate the existing database to include new features"""
-    
-    db_path = 'instance/femboyworld.db'
-    
-    if not os.path.exists(db_path):
-        print("Database not found. Creating new database...")
-        return
-    
-    print("Starting database migration...")
-    
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        print("Checking and updating database schema...")
-        
-        # Always check and add view_count column to posts table if it doesn't exist
-        try:
-            cursor.execute("ALTER TABLE post ADD COLUMN view_count INTEGER DEFAULT 0")
-            print("✓ Added view_count column to posts table")
-        except sqlite3.OperationalError:
-            print("✓ view_count column already exists")
-        
-        # Check if comment table exists, if not create it
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='comment'")
-        if not cursor.fetchone():
-            print("Creating new tables...")
-            
-            # Create comments table
-            cursor.execute("""
-                CREATE TABLE comment (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    content TEXT NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    post_id INTEGER NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    parent_id INTEGER,
-                    FOREIGN KEY (user_id) REFERENCES user (id),
-                    FOREIGN KEY (post_id) REFERENCES post (id),
-                    FOREIGN KEY (parent_id) REFERENCES comment (id)
-                )
-            """)
-            print("✓ Created comments table")
-        else:
-            print("✓ Comments table already exists")
-        
-        # Create notifications table
-        cursor.execute("""
-            CREATE TABLE notification (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                type VARCHAR(50) NOT NULL,
-                title VARCHAR(200) NOT NULL,
-                message TEXT NOT NULL,
-                related_id INTEGER,
-                is_read BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES user (id)
-            )
-        """)
-        print("✓ Created notifications table")
-        
-        # Create followers table
-        cursor.execute("""
-            CREATE TABLE followers (
-                follower_id INTEGER NOT NULL,
-                followed_id INTEGER NOT NULL,
-                PRIMARY KEY (follower_id, followed_id),
-                FOREIGN KEY (follower_id) REFERENCES user (id),
-                FOREIGN KEY (followed_id) REFERENCES user (id)
-            )
-        """)
-        print("✓ Created followers table")
-        
-        # Create support tickets table
-        cursor.execute("""
-            CREATE TABLE support_ticket (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                subject VARCHAR(200) NOT NULL,
-                message TEXT NOT NULL,
-                category VARCHAR(50) NOT NULL,
-                status VARCHAR(20) DEFAULT 'open',
-                priority VARCHAR(20) DEFAULT 'medium',
-                admin_response TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES user (id)
-            )
-        """)
-        print("✓ Created support tickets table")
-        
-        # Create reports table
-        cursor.execute("""
-            CREATE TABLE report (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                reporter_id INTEGER NOT NULL,
-                reported_type VARCHAR(20) NOT NULL,
-                reported_id INTEGER NOT NULL,
-                reason VARCHAR(100) NOT NULL,
-                description TEXT,
-                status VARCHAR(20) DEFAULT 'pending',
-                admin_notes TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                reviewed_at TIMESTAMP,
-                reviewed_by INTEGER,
-                FOREIGN KEY (reporter_id) REFERENCES user (id),
-                FOREIGN KEY (reviewed_by) REFERENCES user (id)
-            )
-        """)
-        print("✓ Created reports table")
-        
-        # Create hashtags table
-        cursor.execute("""
-            CREATE TABLE hashtag (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name VARCHAR(50) UNIQUE NOT NULL,
-                post_count INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        print("✓ Created hashtags table")
-        
-        # Create post-hashtags association table
-        cursor.execute("""
-            CREATE TABLE post_hashtags (
-                post_id INTEGER NOT NULL,
-                hashtag_id INTEGER NOT NULL,
-                PRIMARY KEY (post_id, hashtag_id),
-                FOREIGN KEY (post_id) REFERENCES post (id),
-                FOREIGN KEY (hashtag_id) REFERENCES hashtag (id)
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+from config import Config
+from media_store import MediaStore, blob_digest
+from migrations import AddColumn, Backfill, CreateIndex, Migration, MigrationRunner, RunPython
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_tables(*names):
+    """Step creating missing tables from the app's models (all of them when no names are given)"""
+    def create(runner):
+        from app import db  # the models; importing the app does not touch the database
+
+        tables = [db.metadata.tables[name] for name in names] if names else None
+        with runner.engine.begin() as conn:
+            db.metadata.create_all(conn, tables=tables, checkfirst=True)
+    return RunPython(f'Create missing tables: {", ".join(names) or "all"}', create)
+
+
+def rehash_media(runner, upload_folder=Config.UPLOAD_FOLDER):
+    """Move legacy flat uploads into the content-addressed layout.
+
+    Files are linked (or copied) into place and the posts updated before
+    the old names are removed, so an interrupted run can simply be
+    restarted. Posts that already point at a blob are skipped. Posts are
+    read in primary-key batches; if any file is missing the step fails, so
+    the migration stays pending until the files are restored (or the posts
+    deleted) and it is run again.
+    """
+    if not os.path.isabs(upload_folder):
+        upload_folder = os.path.join(APP_ROOT, upload_folder)
+    store = MediaStore(upload_folder)
+    moved = missing = 0
+    last_id = 0
+
+    while True:
+        with runner.engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT id, media_path FROM post WHERE id > :last_id ORDER BY id LIMIT :limit"
+            ), {'last_id': last_id, 'limit': runner.batch_size}).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        old_files = []
+        with runner.engine.begin() as conn:
+            for post_id, path in rows:
+                if blob_digest(path) is not None:
+                    continue
+                source = os.path.join(upload_folder, path)
+                if not os.path.exists(source):
+                    missing += 1
+                    continue
+                new_path, size = store.save_file(source, path.rsplit('.', 1)[-1], move=False)
+                conn.execute(text("UPDATE post SET media_path = :path WHERE id = :id"), {'path': new_path, 'id': post_id})
+                conn.execute(text(
+                    "INSERT INTO media_blob (path, size, ref_count, created_at) "
+                    "SELECT :path, :size, 0, :now WHERE NOT EXISTS (SELECT 1 FROM media_blob WHERE path = :path)"
+                ), {'path': new_path, 'size': size, 'now': datetime.utcnow()})
+                old_files.append(source)
+                moved += 1
+        for source in old_files:
+            if os.path.exists(source):
+                os.unlink(source)
+        runner.out(f"  rehashed {moved} files (posts up to {last_id})")
+
+    with runner.engine.begin() as conn:
+        conn.execute(text("""
+            UPDATE media_blob SET ref_count = (
+                SELECT COUNT(*) FROM post WHERE post.media_path = media_blob.path
             )
-        """)
-        print("✓ Created post-hashtags association table")
-        
-        # Create mentions table
-        cursor.execute("""
-            CREATE TABLE mention (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                post_id INTEGER NOT NULL,
-                comment_id INTEGER,
-                mentioned_user_id INTEGER NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (post_id) REFERENCES post (id),
-                FOREIGN KEY (comment_id) REFERENCES comment (id),
-                FOREIGN KEY (mentioned_user_id) REFERENCES user (id)
+        """))
+    if missing:
+        raise RuntimeError(
+            f"{missing} posts point at files that do not exist in {upload_folder}; "
+            "restore the files or delete those posts"
+        )
+    return moved
+
+
+def dedupe_likes(runner):
+    """Keep the first like of each (user, post) pair and correct the affected like counts"""
+    with runner.engine.connect() as conn:
+        duplicates = conn.execute(text(
+            'SELECT user_id, post_id, MIN(id) FROM "like" GROUP BY user_id, post_id HAVING COUNT(*) > 1'
+        )).all()
+    for start in range(0, len(duplicates), runner.batch_size):
+        with runner.engine.begin() as conn:
+            for user_id, post_id, keep_id in duplicates[start:start + runner.batch_size]:
+                conn.execute(text(
+                    'DELETE FROM "like" WHERE user_id = :user_id AND post_id = :post_id AND id != :keep_id'
+                ), {'user_id': user_id, 'post_id': post_id, 'keep_id': keep_id})
+                conn.execute(text(
+                    'UPDATE post SET like_count = (SELECT COUNT(*) FROM "like" WHERE "like".post_id = post.id) WHERE id = :post_id'
+                ), {'post_id': post_id})
+        runner.out(f"  removed duplicate likes for {min(start + runner.batch_size, len(duplicates))} of {len(duplicates)} pairs")
+
+
+MIGRATIONS = [
+    Migration(1, 'base tables', create_tables()),
+    Migration(
+        2, 'post view counts',
+        AddColumn('post', 'view_count', 'INTEGER DEFAULT 0'),
+    ),
+    Migration(
+        3, 'denormalized like and comment counters',
+        AddColumn('post', 'like_count', 'INTEGER NOT NULL DEFAULT 0'),
+        AddColumn('post', 'comment_count', 'INTEGER NOT NULL DEFAULT 0'),
+        Backfill('post_counters', 'post', """
+            like_count = (SELECT COUNT(*) FROM "like" WHERE "like".post_id = post.id),
+            comment_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)
+        """),
+    ),
+    Migration(
+        4, 'media dimensions, variants and video metadata',
+        AddColumn('post', 'width', 'INTEGER'),
+        AddColumn('post', 'height', 'INTEGER'),
+        AddColumn('post', 'variants', 'JSON'),
+        AddColumn('post', 'duration', 'FLOAT'),
+        AddColumn('post', 'video_codec', 'VARCHAR(20)'),
+    ),
+    Migration(
+        5, 'unread notification counters',
+        AddColumn('user', 'unread_notification_count', 'INTEGER NOT NULL DEFAULT 0'),
+        Backfill('unread_notification_counts', 'user', """
+            unread_notification_count = (
+                SELECT COUNT(*) FROM notification
+                WHERE notification.user_id = "user".id AND NOT notification.is_read
             )
-        """)
-        print("✓ Created mentions table")
-        
-        # Create indexes for better performance
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comment_post_id ON comment(post_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_comment_user_id ON comment(user_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notification_user_id ON notification(user_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notification_is_read ON notification(is_read)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_followers_follower ON followers(follower_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_followers_followed ON followers(followed_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_ticket_user_id ON support_ticket(user_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_support_ticket_status ON support_ticket(status)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_reporter_id ON report(reporter_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_status ON report(status)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_report_type_id ON report(reported_type, reported_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hashtag_name ON hashtag(name)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_hashtag_post_count ON hashtag(post_count)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_post_hashtags_post ON post_hashtags(post_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_post_hashtags_hashtag ON post_hashtags(hashtag_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mention_post_id ON mention(post_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_mention_user_id ON mention(mentioned_user_id)")
-        print("✓ Created performance indexes")
-        
-        # Commit changes
-        conn.commit()
-        print("\n🎉 Database migration completed successfully!")
-        print("New features available:")
-        print("  • Comments and replies system")
-        print("  • User following system")
-        print("  • Notifications for likes, comments, and follows")
-        print("  • Post view counting")
-        print("  • Enhanced search with filters and pagination")
-        print("  • Support ticket system")
-        print("  • Content reporting system")
-        print("  • Hashtag system with trending hashtags")
-        print("  • User mentions with notifications")
-        
+        """),
+    ),
+    Migration(
+        6, 'lookup indexes',
+        CreateIndex('idx_comment_post_id', 'comment', 'post_id'),
+        CreateIndex('idx_comment_user_id', 'comment', 'user_id'),
+        CreateIndex('idx_notification_user_id', 'notification', 'user_id'),
+        CreateIndex('idx_notification_is_read', 'notification', 'is_read'),
+        CreateIndex('idx_followers_follower', 'followers', 'follower_id'),
+        CreateIndex('idx_followers_followed', 'followers', 'followed_id'),
+        CreateIndex('idx_support_ticket_user_id', 'support_ticket', 'user_id'),
+        CreateIndex('idx_support_ticket_status', 'support_ticket', 'status'),
+        CreateIndex('idx_report_reporter_id', 'report', 'reporter_id'),
+        CreateIndex('idx_report_status', 'report', 'status'),
+        CreateIndex('idx_report_type_id', 'report', 'reported_type, reported_id'),
+        CreateIndex('idx_hashtag_name', 'hashtag', 'name'),
+        CreateIndex('idx_hashtag_post_count', 'hashtag', 'post_count'),
+        CreateIndex('idx_post_hashtags_post', 'post_hashtags', 'post_id'),
+        CreateIndex('idx_post_hashtags_hashtag', 'post_hashtags', 'hashtag_id'),
+        CreateIndex('idx_mention_post_id', 'mention', 'post_id'),
+        CreateIndex('idx_mention_user_id', 'mention', 'mentioned_user_id'),
+    ),
+    Migration(
+        7, 'feed and notification indexes',
+        CreateIndex('idx_post_created_id', 'post', 'created_at, id'),
+        CreateIndex('idx_post_user_created_id', 'post', 'user_id, created_at, id'),
+        CreateIndex('idx_post_hashtags_hashtag_post', 'post_hashtags', 'hashtag_id, post_id'),
+        CreateIndex('idx_notification_user_read_created', 'notification', 'user_id, is_read, created_at'),
+        CreateIndex('idx_timeline_entry_user_created', 'timeline_entry', 'user_id, created_at, post_id'),
+        CreateIndex('idx_timeline_entry_user_author', 'timeline_entry', 'user_id, author_id'),
+    ),
+    Migration(
+        8, 'content-addressed media storage',
+        create_tables('media_blob'),
+        CreateIndex('idx_post_media_path', 'post', 'media_path'),
+        RunPython('Move uploads to ab/cd/<sha256>.<ext> and count their references', rehash_media),
+    ),
+    Migration(9, 'read replica heartbeat', create_tables('replica_heartbeat')),
+    Migration(
+        10, 'partial indexes',
+        CreateIndex('idx_post_trending', 'post', 'created_at, like_count', where='like_count > 0'),
+        CreateIndex('idx_post_unprocessed', 'post', 'id', where='variants IS NULL'),
+        CreateIndex('idx_notification_unread', 'notification', 'user_id, created_at', where='NOT is_read'),
+        CreateIndex('idx_report_pending', 'report', 'created_at', where="status = 'pending'"),
+    ),
+    Migration(
+        11, 'prefix search indexes',
+        # LIKE 'abc%' can only use a plain index under the C collation on Postgres
+        CreateIndex('idx_hashtag_name_prefix', 'hashtag', 'name text_pattern_ops', dialects=('postgresql',)),
+        CreateIndex('idx_user_username_prefix', 'user', 'username text_pattern_ops', dialects=('postgresql',)),
+    ),
+    Migration(
+        12, 'like indexes and one like per user and post',
+        # post.user_id and post.created_at already lead idx_post_user_created_id and idx_post_created_id
+        RunPython('Remove duplicate likes', dedupe_likes),
+        CreateIndex('uq_like_user_post', 'like', 'user_id, post_id', unique=True),
+        CreateIndex('idx_like_post_id', 'like', 'post_id'),
+    ),
+]
+
+
+def database_url(url=None):
+    """The app's database URL; relative SQLite paths live in instance/, as under Flask-SQLAlchemy"""
+    url = make_url(url or Config.SQLALCHEMY_DATABASE_URI)
+    if url.get_backend_name() == 'sqlite' and url.database and url.database != ':memory:' and not os.path.isabs(url.database):
+        os.makedirs(os.path.join(APP_ROOT, 'instance'), exist_ok=True)
+        url = url.set(database=os.path.join(APP_ROOT, 'instance', url.database))
+    return url
+
+
+def migrate_database(url=None, dry_run=False, target=None, batch_size=1000, batch_pause=0.0, lock_timeout=5):
+    """Apply (or with dry_run, list) the pending migrations"""
+    engine = create_engine(database_url(url))
+    runner = MigrationRunner(engine, MIGRATIONS, batch_size=batch_size, batch_pause=batch_pause, lock_timeout=lock_timeout)
+    try:
+        if dry_run:
+            runner.plan(target)
+            return
+        print(f"Migrating {engine.url.render_as_string(hide_password=True)}")
+        applied = runner.run(target)
+        if applied:
+            print(f"\n🎉 Applied migrations {', '.join(map(str, applied))}")
+        else:
+            print("✓ Schema is up to date")
     except Exception as e:
         print(f"❌ Migration failed: {e}")
-        conn.rollback()
+        print("Fix the problem and run the script again; finished steps and backfill progress are kept.")
+        raise SystemExit(1)
     finally:
-        conn.close()
+        engine.dispose()
+
+
+def print_status(url=None):
+    engine = create_engine(database_url(url))
+    runner = MigrationRunner(engine, MIGRATIONS)
+    applied = runner.applied()
+    for migration in MIGRATIONS:
+        when = applied.get(migration.version)
+        print(f"{migration.version:>4}  {'✓ ' + str(when) if when else 'pending':<30} {migration.name}")
+    engine.dispose()
+
 
 if __name__ == "__main__":
-    migrate_database()
+    parser = argparse.ArgumentParser(description="Apply FemboyWorld schema migrations")
+    parser.add_argument('--database-url', help='defaults to DATABASE_URL / the app config')
+    parser.add_argument('--dry-run', action='store_true', help='print the pending steps without running them')
+    parser.add_argument('--status', action='store_true', help='list migrations and when they were applied')
+    parser.add_argument('--target', type=int, help='stop after this version')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows per backfill transaction')
+    parser.add_argument('--batch-pause', type=float, default=0.0, help='seconds to sleep between backfill batches')
+    parser.add_argument('--lock-timeout', type=float, default=5, help='seconds to wait for a table lock (Postgres)')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status(args.database_url)
+    else:
+        migrate_database(args.database_url, args.dry_run, args.target, args.batch_size, args.batch_pause, args.lock_timeout)
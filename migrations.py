@@ -0,0 +1,280 @@
+"""
+Versioned schema migrations for FemboyWorld.
+Each Migration is a numbered list of idempotent steps; the versions that
+have been applied are recorded in the schema_version table, so running
+the migrations again only does what is missing. Indexes are built with
+CREATE INDEX CONCURRENTLY on Postgres, and backfills update rows in
+primary-key batches, committing and saving their position after each one
+so an interrupted run resumes where it stopped. The migrations themselves
+live in migrate_db.py.
+"""
+
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+ADVISORY_LOCK_ID = 0x66776d67  # only one migration run at a time on Postgres
+
+
+class Step(ABC):
+    """One idempotent change within a migration"""
+
+    @abstractmethod
+    def describe(self, conn):
+        """What the step would do, for --dry-run"""
+
+    @abstractmethod
+    def apply(self, runner):
+        """Make the change, skipping whatever is already in place"""
+
+
+class AddColumn(Step):
+    """ALTER TABLE ... ADD COLUMN, skipped when the column exists"""
+
+    def __init__(self, table, column, ddl):
+        self.table = table
+        self.column = column
+        self.ddl = ddl
+
+    def statement(self, conn):
+        quote = conn.dialect.identifier_preparer.quote
+        return f'ALTER TABLE {quote(self.table)} ADD COLUMN {quote(self.column)} {self.ddl}'
+
+    def exists(self, conn):
+        inspector = inspect(conn)
+        return inspector.has_table(self.table) and self.column in {
+            column['name'] for column in inspector.get_columns(self.table)
+        }
+
+    def describe(self, conn):
+        if not inspect(conn).has_table(self.table):
+            return f'{self.table}.{self.column}: table created by an earlier step'
+        if self.exists(conn):
+            return f'{self.table}.{self.column} already exists'
+        return f'{self.statement(conn)};'
+
+    def apply(self, runner):
+        with runner.engine.begin() as conn:
+            if self.exists(conn):
+                return
+            runner.set_lock_timeout(conn)
+            conn.execute(text(self.statement(conn)))
+        runner.out(f'  added {self.table}.{self.column}')
+
+
+class CreateIndex(Step):
+    """CREATE INDEX IF NOT EXISTS, CONCURRENTLY on Postgres so writes continue during the build"""
+
+    def __init__(self, name, table, columns, unique=False, where=None, dialects=None):
+        self.name = name
+        self.table = table
+        self.columns = columns
+        self.unique = unique
+        self.where = where
+        self.dialects = dialects
+
+    def statement(self, conn):
+        quote = conn.dialect.identifier_preparer.quote
+        concurrently = ' CONCURRENTLY' if conn.dialect.name == 'postgresql' else ''
+        unique = ' UNIQUE' if self.unique else ''
+        where = f' WHERE {self.where}' if self.where else ''
+        return f'CREATE{unique} INDEX{concurrently} IF NOT EXISTS {self.name} ON {quote(self.table)} ({self.columns}){where}'
+
+    def invalid(self, conn):
+        """A CONCURRENTLY build that failed leaves an invalid index behind, which IF NOT EXISTS would keep"""
+        if conn.dialect.name != 'postgresql':
+            return False
+        return bool(conn.execute(text(
+            'SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :name AND NOT pg_index.indisvalid'
+        ), {'name': self.name}).scalar())
+
+    def describe(self, conn):
+        return f'{self.statement(conn)};'
+
+    def apply(self, runner):
+        # Outside a transaction: CONCURRENTLY cannot run inside one
+        with runner.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            if not inspect(conn).has_table(self.table):
+                return  # optional table (e.g. timelines with another TIMELINE_BACKEND)
+            if self.invalid(conn):
+                runner.out(f'  rebuilding invalid index {self.name}')
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {self.name}'))
+            started = time.monotonic()
+            conn.execute(text(self.statement(conn)))
+        runner.out(f'  index {self.name} ({time.monotonic() - started:.1f}s)')
+
+
+class Backfill(Step):
+    """UPDATE ... SET in primary-key batches, resumable.
+
+    `assignments` is the SET clause; it may refer to the table by name for
+    correlated subqueries. Progress is saved with every batch.
+    """
+
+    def __init__(self, name, table, assignments, where=None, key='id'):
+        self.name = name
+        self.table = table
+        self.assignments = assignments
+        self.where = where
+        self.key = key
+
+    def describe(self, conn):
+        quote = conn.dialect.identifier_preparer.quote
+        where = f' WHERE {self.where}' if self.where else ''
+        assignments = ' '.join(self.assignments.split())
+        return f'UPDATE {quote(self.table)} SET {assignments}{where}; -- {self.name}, in batches by {self.key}'
+
+    def apply(self, runner):
+        quote = runner.engine.dialect.identifier_preparer.quote
+        table = quote(self.table)
+        where = f' AND ({self.where})' if self.where else ''
+        position = runner.progress(self.name)
+        with runner.engine.connect() as conn:
+            total = conn.execute(text(f'SELECT COUNT(*) FROM {table} WHERE {self.key} > :position'), {'position': position}).scalar()
+        if position:
+            runner.out(f'  resuming {self.name} after {self.key} {position}')
+
+        done = 0
+        started = time.monotonic()
+        while True:
+            with runner.engine.begin() as conn:
+                runner.set_lock_timeout(conn)
+                keys = conn.execute(text(
+                    f'SELECT {self.key} FROM {table} WHERE {self.key} > :position ORDER BY {self.key} LIMIT :limit'
+                ), {'position': position, 'limit': runner.batch_size}).scalars().all()
+                if not keys:
+                    break
+                conn.execute(text(
+                    f'UPDATE {table} SET {self.assignments} WHERE {self.key} > :low AND {self.key} <= :high{where}'
+                ), {'low': position, 'high': keys[-1]})
+                position = keys[-1]
+                runner.save_progress(conn, self.name, position)
+            done += len(keys)
+            elapsed = time.monotonic() - started
+            runner.out(f'  {self.name}: {done}/{total} rows ({done * 100 // max(total, 1)}%, {done / max(elapsed, 1e-6):.0f} rows/s)')
+            if runner.batch_pause:
+                time.sleep(runner.batch_pause)  # let the site's own writes in between batches
+
+
+class RunPython(Step):
+    """func(runner) for changes SQL cannot express; must be safe to repeat"""
+
+    def __init__(self, description, func):
+        self.description = description
+        self.func = func
+
+    def describe(self, conn):
+        return self.description
+
+    def apply(self, runner):
+        self.func(runner)
+
+
+class Migration:
+    def __init__(self, version, name, *steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+class MigrationRunner:
+    """Apply pending migrations in order and record them in schema_version"""
+
+    def __init__(self, engine, migrations, batch_size=1000, batch_pause=0.0, lock_timeout=5, out=print):
+        versions = [migration.version for migration in migrations]
+        if versions != sorted(set(versions)):
+            raise ValueError('Migration versions must be unique and in increasing order')
+        self.engine = engine
+        self.migrations = migrations
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.lock_timeout = lock_timeout
+        self.out = out
+
+    def set_lock_timeout(self, conn):
+        """Give up on a DDL lock instead of queueing every request behind it (Postgres)"""
+        if conn.dialect.name == 'postgresql' and self.lock_timeout:
+            conn.execute(text(f"SET LOCAL lock_timeout = '{int(self.lock_timeout * 1000)}ms'"))
+
+    def _ensure_tables(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                'CREATE TABLE IF NOT EXISTS schema_version ('
+                'version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at TIMESTAMP NOT NULL)'
+            ))
+            conn.execute(text(
+                'CREATE TABLE IF NOT EXISTS schema_migration_progress ('
+                'step VARCHAR(100) PRIMARY KEY, position BIGINT NOT NULL, updated_at TIMESTAMP NOT NULL)'
+            ))
+
+    def applied(self):
+        """{version: applied_at} of the migrations already run"""
+        with self.engine.connect() as conn:
+            if not inspect(conn).has_table('schema_version'):
+                return {}
+            return dict(conn.execute(text('SELECT version, applied_at FROM schema_version')).all())
+
+    def pending(self, target=None):
+        applied = self.applied()
+        return [
+            migration for migration in self.migrations
+            if migration.version not in applied and (target is None or migration.version <= target)
+        ]
+
+    def progress(self, step):
+        with self.engine.connect() as conn:
+            return conn.execute(text('SELECT position FROM schema_migration_progress WHERE step = :step'), {'step': step}).scalar() or 0
+
+    def save_progress(self, conn, step, position):
+        values = {'step': step, 'position': position, 'now': datetime.utcnow()}
+        if not conn.execute(text(
+            'UPDATE schema_migration_progress SET position = :position, updated_at = :now WHERE step = :step'
+        ), values).rowcount:
+            conn.execute(text(
+                'INSERT INTO schema_migration_progress (step, position, updated_at) VALUES (:step, :position, :now)'
+            ), values)
+
+    def _steps(self, migration):
+        dialect = self.engine.dialect.name
+        return [step for step in migration.steps if getattr(step, 'dialects', None) in (None, ()) or dialect in step.dialects]
+
+    def plan(self, target=None):
+        """Print what run() would do, without changing anything"""
+        pending = self.pending(target)
+        if not pending:
+            self.out('Schema is up to date')
+            return pending
+        with self.engine.connect() as conn:
+            for migration in pending:
+                self.out(f'{migration.version:>4}  {migration.name}')
+                for step in self._steps(migration):
+                    self.out('      ' + step.describe(conn).replace('\n', '\n      '))
+        return pending
+
+    def run(self, target=None):
+        """Apply every pending migration up to `target`; returns the versions applied"""
+        self._ensure_tables()
+        lock = None
+        if self.engine.dialect.name == 'postgresql':
+            # Autocommit: an open transaction here would make CREATE INDEX CONCURRENTLY wait for it
+            lock = self.engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+            lock.execute(text('SELECT pg_advisory_lock(:id)'), {'id': ADVISORY_LOCK_ID})
+        try:
+            applied = []
+            for migration in self.pending(target):  # after taking the lock: another run may have finished
+                self.out(f'Applying {migration.version} {migration.name}')
+                for step in self._steps(migration):
+                    step.apply(self)
+                with self.engine.begin() as conn:
+                    conn.execute(text(
+                        'INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :now)'
+                    ), {'version': migration.version, 'name': migration.name, 'now': datetime.utcnow()})
+                applied.append(migration.version)
+            return applied
+        finally:
+            if lock is not None:
+                lock.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': ADVISORY_LOCK_ID})
+                lock.close()
@@ -0,0 +1,390 @@
+"""
+Background notification delivery for FemboyWorld.
+Requests only enqueue notifications; a worker thread drains the queue
+every NOTIFICATION_BATCH_WINDOW seconds, collapses bursts ("alice and 12
+others liked your post") and bulk inserts the batch in one transaction.
+With NOTIFICATION_OUTBOX set, the queue is a small SQLite file so nothing
+is lost when a worker restarts. A batch that keeps failing is split up
+after NOTIFICATION_MAX_ATTEMPTS tries, and rows that still fail on their
+own are dead-lettered (logged, and kept in the outbox's dead_letter table)
+so they can't hold up everything queued behind them.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from background import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+# Notification types that may be merged, and the fields that identify a burst
+COLLAPSE_KEYS = {
+    'like': ('user_id', 'type', 'related_id'),
+    'comment': ('user_id', 'type', 'related_id'),
+    'follow': ('user_id', 'type'),
+}
+
+COLUMNS = ('user_id', 'type', 'title', 'message', 'related_id', 'created_at')
+
+
+def collapse(rows):
+    """Merge bursts of the same notification into one row per recipient.
+
+    Rows carry the acting username in 'actor'; a merged row keeps the
+    newest event and rewrites its leading actor as "<actor> and N others".
+    """
+    groups = {}
+    order = []
+    for row in rows:
+        fields = COLLAPSE_KEYS.get(row['type'])
+        key = tuple(row.get(field) for field in fields) if fields and row.get('actor') else id(row)
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(row)
+
+    collapsed = []
+    for key in order:
+        group = groups[key]
+        row = dict(group[-1])
+        actors = list(dict.fromkeys(item['actor'] for item in group if item.get('actor')))
+        if len(actors) > 1:
+            actor = row['actor']
+            others = len(actors) - 1
+            replacement = f'{actor} and {others} other{"s" if others > 1 else ""}'
+            for field in ('title', 'message'):
+                if row[field].startswith(actor):
+                    row[field] = replacement + row[field][len(actor):]
+        collapsed.append(row)
+    return collapsed
+
+
+class SQLiteOutbox:
+    """Durable at-least-once queue in a local SQLite file, shared by all workers"""
+
+    CLAIM_TIMEOUT = 60  # seconds before rows claimed by a dead worker are retried
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, "
+                "claimed_by TEXT, claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(outbox)')}
+            if 'attempts' not in columns:
+                conn.execute('ALTER TABLE outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letter ("
+                "id INTEGER PRIMARY KEY, payload TEXT NOT NULL, attempts INTEGER NOT NULL, failed_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def put(self, rows):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT INTO outbox (payload) VALUES (?)',
+                [(json.dumps(row, default=str),) for row in rows]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def claim(self, limit):
+        """Claim up to `limit` rows for this process, returning (ids, rows).
+
+        Rows carry the number of earlier failed writes in 'attempts'.
+        """
+        owner = f'{os.getpid()}:{threading.get_ident()}'
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'UPDATE outbox SET claimed_by = ?, claimed_at = ? WHERE id IN ('
+                'SELECT id FROM outbox WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY id LIMIT ?)',
+                (owner, now, now - self.CLAIM_TIMEOUT, limit)
+            )
+            claimed = conn.execute(
+                'SELECT id, payload, attempts FROM outbox WHERE claimed_by = ? AND claimed_at = ? ORDER BY id',
+                (owner, now)
+            ).fetchall()
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return (
+            [row_id for row_id, _, _ in claimed],
+            [dict(json.loads(payload), attempts=attempts) for _, payload, attempts in claimed]
+        )
+
+    def ack(self, ids):
+        conn = self._connect()
+        conn.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in ids])
+
+    def release(self, ids):
+        """Return rows whose write failed to the queue, counting the attempt"""
+        conn = self._connect()
+        conn.executemany(
+            'UPDATE outbox SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1 WHERE id = ?',
+            [(row_id,) for row_id in ids]
+        )
+
+    def dead_letter(self, ids):
+        """Move rows that can't be written out of the queue"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(
+                'INSERT OR REPLACE INTO dead_letter (id, payload, attempts, failed_at) '
+                'SELECT id, payload, attempts + 1, ? FROM outbox WHERE id = ?',
+                [(time.time(), row_id) for row_id in ids]
+            )
+            conn.executemany('DELETE FROM outbox WHERE id = ?', [(row_id,) for row_id in ids])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+
+class NotificationDispatcher:
+    """Queue notifications in the request, write them in batches in the background"""
+
+    def __init__(self, app=None, db=None, table=None):
+        self.app = None
+        self.db = None
+        self.table = None
+        self.outbox = None
+        self._queue = queue.Queue()
+        self._task = None
+        self._write_lock = threading.Lock()
+        self._listeners = []
+        self._committed_listeners = []
+
+        # Counters
+        self.enqueued = 0
+        self.written = 0
+        self.collapsed = 0
+        self.batches = 0
+        self.failed_batches = 0
+        self.dead_lettered = 0
+
+        if app is not None:
+            self.init_app(app, db, table)
+
+    def init_app(self, app, db, table):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.asynchronous = app.config.get('NOTIFICATIONS_ASYNC', True)
+        self.batch_size = app.config.get('NOTIFICATION_BATCH_SIZE', 500)
+        self.max_attempts = app.config.get('NOTIFICATION_MAX_ATTEMPTS', 10)
+        outbox_path = app.config.get('NOTIFICATION_OUTBOX')
+        if outbox_path and self.asynchronous:
+            self.outbox = SQLiteOutbox(outbox_path)
+        self._task = PeriodicTask(
+            'notification-dispatcher',
+            app.config.get('NOTIFICATION_BATCH_WINDOW', 1.0),
+            self.drain,
+            run_immediately=self.outbox is not None  # pick up rows left by a previous run
+        )
+        if self.outbox is not None:
+            app.before_request(self._start)
+        atexit.register(self.shutdown)
+
+    def _start(self):
+        # Started with the first request rather than the first enqueue, so
+        # rows left in the outbox by a crashed worker don't wait for one
+        self._task.ensure_started()
+
+    def on_written(self, callback):
+        """Register callback(connection, rows), run inside each batch's transaction"""
+        self._listeners.append(callback)
+        return callback
+
+    def on_committed(self, callback):
+        """Register callback(rows), run after each batch commits; rows carry their 'id'"""
+        self._committed_listeners.append(callback)
+        return callback
+
+    def enqueue(self, user_id, type, title, message, related_id=None, actor=None):
+        self.enqueue_many([{
+            'user_id': user_id,
+            'type': type,
+            'title': title,
+            'message': message,
+            'related_id': related_id,
+            'actor': actor,
+        }])
+
+    def enqueue_many(self, rows):
+        """Hand notifications to the dispatcher; returns immediately in async mode"""
+        if not rows:
+            return
+        now = datetime.utcnow()
+        rows = [dict(row, created_at=row.get('created_at') or now) for row in rows]
+        self.enqueued += len(rows)
+
+        if not self.asynchronous:
+            self.write(rows)
+            return
+
+        if self.outbox is not None:
+            try:
+                self.outbox.put(rows)
+            except sqlite3.Error:
+                logger.exception('Notification outbox unavailable, queueing in memory')
+                self._put_memory(rows)
+        else:
+            self._put_memory(rows)
+        self._task.ensure_started()
+
+    def _put_memory(self, rows):
+        for row in rows:
+            self._queue.put(row)
+
+    def drain(self):
+        """Write everything queued so far, in batches of NOTIFICATION_BATCH_SIZE"""
+        while self._drain_memory():
+            pass
+        if self.outbox is not None:
+            while self._drain_outbox():
+                pass
+
+    def _drain_memory(self):
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not rows:
+            return False
+        if self.write(rows):
+            return True
+        for row in rows:
+            row['attempts'] = row.get('attempts', 0) + 1
+        if max(row['attempts'] for row in rows) < self.max_attempts:
+            self._put_memory(rows)  # retry on the next tick
+            return False
+        dead = [rows[i] for i in self._isolate(rows)]
+        if dead:
+            self._dead_lettered(dead, ', '.join(json.dumps(row, default=str) for row in dead))
+        return True
+
+    def _drain_outbox(self):
+        ids, rows = self.outbox.claim(self.batch_size)
+        if not rows:
+            return False
+        for row in rows:
+            if isinstance(row.get('created_at'), str):
+                row['created_at'] = datetime.fromisoformat(row['created_at'])
+        if self.write(rows):
+            self.outbox.ack(ids)
+            return True
+        if max(row['attempts'] for row in rows) + 1 < self.max_attempts:
+            self.outbox.release(ids)
+            return False
+        failed = set(self._isolate(rows))
+        self.outbox.ack([row_id for i, row_id in enumerate(ids) if i not in failed])
+        if failed:
+            dead_ids = [ids[i] for i in sorted(failed)]
+            self.outbox.dead_letter(dead_ids)
+            self._dead_lettered(dead_ids, 'outbox ids ' + ', '.join(map(str, dead_ids)))
+        return True
+
+    def _isolate(self, rows):
+        """Write a failing batch in halves down to single rows; returns the positions that still fail"""
+        if len(rows) == 1:
+            return [0]
+        middle = len(rows) // 2
+        failed = []
+        for offset, part in ((0, rows[:middle]), (middle, rows[middle:])):
+            if not self.write(part):
+                failed += [offset + i for i in self._isolate(part)]
+        return failed
+
+    def _dead_lettered(self, rows, detail):
+        self.dead_lettered += len(rows)
+        logger.error('Dead-lettered %d notifications after %d failed writes: %s', len(rows), self.max_attempts, detail)
+
+    def write(self, rows):
+        """Collapse and bulk insert one batch in a single transaction"""
+        merged = collapse(rows)
+        records = [{column: row.get(column) for column in COLUMNS} for row in merged]
+        try:
+            with self._write_lock, self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    if conn.dialect.insert_executemany_returning_sort_by_parameter_order:
+                        inserted = conn.execute(
+                            self.table.insert().returning(self.table.c.id, sort_by_parameter_order=True),
+                            records
+                        )
+                        for record, row_id in zip(records, inserted.scalars()):
+                            record['id'] = row_id
+                    else:
+                        conn.execute(self.table.insert(), records)
+                    for callback in self._listeners:
+                        callback(conn, records)
+        except Exception:
+            self.failed_batches += 1
+            logger.exception('Failed to write %d notifications', len(records))
+            if not self.asynchronous:
+                raise
+            return False
+
+        self.batches += 1
+        self.written += len(records)
+        self.collapsed += len(rows) - len(records)
+        for callback in self._committed_listeners:
+            try:
+                callback(records)
+            except Exception:
+                logger.exception('Notification listener %r failed', callback)
+        return True
+
+    def shutdown(self):
+        """Stop the worker and write whatever is still queued"""
+        if self._task is not None:
+            self._task.stop()
+            self.drain()
+
+    def stats(self):
+        return {
+            'asynchronous': self.asynchronous,
+            'enqueued': self.enqueued,
+            'queued_in_memory': self._queue.qsize(),
+            'queued_in_outbox': len(self.outbox) if self.outbox is not None else None,
+            'written': self.written,
+            'collapsed': self.collapsed,
+            'batches': self.batches,
+            'failed_batches': self.failed_batches,
+            'dead_lettered': self.dead_lettered,
+        }
@@ -0,0 +1,48 @@
+"""
+Keyset (cursor) pagination for FemboyWorld feeds.
+Pages are addressed by the (created_at, id) of the last post shown, so
+page 100 costs the same index range scan as page 1, unlike OFFSET.
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(created_at, post_id):
+    """Opaque cursor pointing just past (created_at, post_id)"""
+    raw = f'{created_at.isoformat()}|{post_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (created_at, post_id) for a cursor, None for an empty one.
+
+    Raises ValueError for anything that isn't a cursor we issued.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, post_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+
+
+def keyset_paginate(query, model, before=None, limit=20):
+    """Newest-first page of `query` strictly older than the `before` position.
+
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    """
+    if before is not None:
+        query = query.filter(tuple_(model.created_at, model.id) < tuple_(*before))
+
+    items = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(last.created_at, last.id)
+    return items, next_cursor
@@ -0,0 +1,112 @@
+"""
+Query-count guard for catching N+1 regressions.
+`count_queries()` / `assert_max_queries()` wrap a block (e.g. a test
+client request) and count the SQL statements it runs. `QueryBudget`
+does the same per request in the app: a request over QUERY_BUDGET is
+logged with its statements, or fails with QUERY_BUDGET_STRICT.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    """Statements executed on this thread while active"""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def report(self, limit=10):
+        shown = '\n'.join(f'  {statement}' for statement in self.statements[:limit])
+        more = self.count - limit
+        return shown + (f'\n  ... and {more} more' if more > 0 else '')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_local, 'counters', ()):
+        counter.statements.append(statement)
+    if has_request_context():
+        counter = g.get('_query_counter')
+        if counter is not None:
+            counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """Count the statements run by this thread inside the block"""
+    counter = QueryCounter()
+    counters = _local.__dict__.setdefault('counters', [])
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """Fail if the block runs more than `budget` statements (for tests)"""
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded(f'{counter.count} queries, budget is {budget}:\n{counter.report()}')
+
+
+def query_budget(budget):
+    """Per-view override of QUERY_BUDGET, for routes that legitimately do more"""
+    def decorator(view):
+        view.query_budget = budget
+        return view
+    return decorator
+
+
+class QueryBudget:
+    """Per-request query counting, enabled by QUERY_BUDGET > 0"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.budget = app.config.get('QUERY_BUDGET', 0)
+        self.strict = app.config.get('QUERY_BUDGET_STRICT', False)
+        if self.budget > 0:
+            app.before_request(self._start)
+            app.after_request(self._check)
+
+    def _start(self):
+        g._query_counter = QueryCounter()
+
+    def _check(self, response):
+        counter = g.pop('_query_counter', None)
+        if counter is None:
+            return response
+        view = self.app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', self.budget)
+        if self.app.debug or self.app.testing:
+            response.headers['X-Query-Count'] = str(counter.count)
+        if counter.count > budget:
+            message = f'{request.method} {request.path} ran {counter.count} queries, budget is {budget}:\n{counter.report()}'
+            if self.strict:
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
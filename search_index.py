@@ -0,0 +1,188 @@
+"""
+Full-text search index for FemboyWorld posts.
+Uses an FTS5 virtual table on SQLite and a tsvector table with a GIN index
+on PostgreSQL, so /search no longer runs `LIKE '%q%'` over every post.
+The index is created by `flask search-rebuild`; until it exists the
+search route keeps using the LIKE queries.
+"""
+
+import re
+import time
+from abc import ABC, abstractmethod
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+MAX_TERMS = 8
+
+
+def search_terms(query):
+    """Split user input into plain word tokens (drops # and @ and operators)"""
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+class SearchIndex(ABC):
+    """Common behaviour for the dialect-specific indexes"""
+
+    CHECK_INTERVAL = 60  # seconds between checks while the index is missing
+
+    def __init__(self, db):
+        self.db = db
+        self._available = False
+        self._checked_at = 0
+
+    def available(self):
+        """True if the index table exists (re-checked periodically until it does)"""
+        if not self._available and time.monotonic() - self._checked_at > self.CHECK_INTERVAL:
+            self._checked_at = time.monotonic()
+            self._available = self._exists()
+        return self._available
+
+    @abstractmethod
+    def _exists(self):
+        """True if the index table exists in the database"""
+
+    @abstractmethod
+    def create(self):
+        """Create the index structures (idempotent)"""
+
+    def index_post(self, post, connection=None):
+        """Add or refresh a post in the index"""
+        if not self.available():
+            return
+        params = {
+            'post_id': post.id,
+            'title': post.title or '',
+            'description': post.description or '',
+            'tags': post.tags or '',
+            'hashtags': ' '.join(hashtag.name for hashtag in post.hashtags),
+        }
+        executor = connection if connection is not None else self.db.session
+        executor.execute(self.DELETE, {'post_id': post.id})
+        executor.execute(self.INSERT, params)
+
+    def remove_post(self, post_id, connection=None):
+        if not self.available():
+            return
+        executor = connection if connection is not None else self.db.session
+        executor.execute(self.DELETE, {'post_id': post_id})
+
+    @staticmethod
+    @abstractmethod
+    def build_query(terms):
+        """The dialect's full-text query matching every term"""
+
+    def rebuild(self, fetch_batch, batch_size=1000):
+        """Create the index and (re)index every post.
+
+        `fetch_batch(after_id, limit)` returns the next posts ordered by id.
+        """
+        self.create()
+        self.db.session.commit()
+        self._available = True
+        self.db.session.execute(self.CLEAR)
+        indexed = 0
+        last_id = 0
+        while True:
+            batch = fetch_batch(last_id, batch_size)
+            if not batch:
+                break
+            for post in batch:
+                self.index_post(post)
+            self.db.session.commit()
+            indexed += len(batch)
+            last_id = batch[-1].id
+        return indexed
+
+    def search(self, query, page=1, per_page=20):
+        """Post ids ranked by relevance, as (ids, has_more)"""
+        terms = search_terms(query)
+        if not terms:
+            return [], False
+        rows = self.db.session.execute(self.SEARCH, {
+            'query': self.build_query(terms),
+            'limit': per_page + 1,
+            'offset': (page - 1) * per_page,
+        }).scalars().all()
+        return rows[:per_page], len(rows) > per_page
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """FTS5 index; the virtual table's rowid is the post id"""
+
+    DELETE = text("DELETE FROM post_fts WHERE rowid = :post_id")
+    INSERT = text(
+        "INSERT INTO post_fts (rowid, title, description, tags, hashtags) "
+        "VALUES (:post_id, :title, :description, :tags, :hashtags)"
+    )
+    CLEAR = text("DELETE FROM post_fts")
+    # Column weights: title, description, tags, hashtags
+    SEARCH = text(
+        "SELECT rowid FROM post_fts WHERE post_fts MATCH :query "
+        "ORDER BY bm25(post_fts, 10.0, 2.0, 5.0, 5.0) LIMIT :limit OFFSET :offset"
+    )
+
+    def _exists(self):
+        row = self.db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'post_fts'")
+        ).first()
+        return row is not None
+
+    def create(self):
+        self.db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+            "title, description, tags, hashtags, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+
+    @staticmethod
+    def build_query(terms):
+        # Every term must match; the last one is a prefix so partial words work
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+
+
+class PostgresSearchIndex(SearchIndex):
+    """tsvector document per post with a GIN index"""
+
+    DELETE = text("DELETE FROM post_search WHERE post_id = :post_id")
+    INSERT = text(
+        "INSERT INTO post_search (post_id, document) VALUES (:post_id, "
+        "setweight(to_tsvector('simple', :title), 'A') || "
+        "setweight(to_tsvector('simple', :tags || ' ' || :hashtags), 'B') || "
+        "setweight(to_tsvector('simple', :description), 'C'))"
+    )
+    CLEAR = text("TRUNCATE post_search")
+    SEARCH = text(
+        "SELECT post_id FROM post_search, to_tsquery('simple', :query) AS query "
+        "WHERE document @@ query "
+        "ORDER BY ts_rank(document, query) DESC, post_id DESC LIMIT :limit OFFSET :offset"
+    )
+
+    def _exists(self):
+        return self.db.session.execute(text("SELECT to_regclass('post_search')")).scalar() is not None
+
+    def create(self):
+        self.db.session.execute(text(
+            "CREATE TABLE IF NOT EXISTS post_search ("
+            "post_id INTEGER PRIMARY KEY REFERENCES post (id) ON DELETE CASCADE, "
+            "document TSVECTOR NOT NULL)"
+        ))
+        self.db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS idx_post_search_document ON post_search USING GIN (document)"
+        ))
+
+    @staticmethod
+    def build_query(terms):
+        return ' & '.join(terms[:-1] + [f'{terms[-1]}:*'])
+
+
+def create_search_index(db, database_uri):
+    """Search index for the database in use, or None if it has no full-text support here"""
+    backend = make_url(database_uri).get_backend_name()
+    if backend == 'sqlite':
+        return SQLiteSearchIndex(db)
+    if backend in ('postgresql', 'postgres'):
+        return PostgresSearchIndex(db)
+    return None
@@ -0,0 +1,338 @@
+"""
+Materialized home timelines for FemboyWorld's following feed.
+New posts are pushed to followers' timelines when they are uploaded
+(fan-out-on-write), so the following feed reads a short, pre-sorted list
+instead of running `user_id IN (<every followed user>)` and sorting.
+Authors with very large follower counts are marked as "pull" authors;
+their posts are merged in at read time (fan-out-on-read) instead.
+
+All backends share the same small, sorted-set shaped interface:
+timelines hold (created_at, post_id, author_id) entries, newest first.
+"""
+
+import threading
+from abc import ABC, abstractmethod
+from bisect import insort
+from datetime import datetime, timedelta
+
+from database import insert_ignore
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class TimelineStore(ABC):
+    """Interface for timeline backends"""
+
+    def __init__(self, max_length=800):
+        self.max_length = max_length
+
+    @abstractmethod
+    def exists(self, user_id):
+        """True once a timeline has been built for the user"""
+
+    @abstractmethod
+    def build(self, user_id, entries):
+        """Replace a user's timeline with `entries` and mark it as built"""
+
+    @abstractmethod
+    def push(self, follower_ids, created_at, post_id, author_id):
+        """Add a new post to the built timelines of `follower_ids`"""
+
+    @abstractmethod
+    def add_many(self, user_id, entries):
+        """Merge entries into an existing timeline (e.g. after a follow)"""
+
+    @abstractmethod
+    def remove_author(self, user_id, author_id):
+        """Drop every entry by `author_id` (e.g. after an unfollow)"""
+
+    @abstractmethod
+    def page(self, user_id, before=None, limit=20):
+        """Up to `limit` (created_at, post_id) pairs older than `before`"""
+
+    @abstractmethod
+    def add_pull_author(self, author_id):
+        """Merge this author's posts in at read time instead of pushing them"""
+
+    @abstractmethod
+    def pull_authors(self):
+        """Authors whose posts are merged in at read time"""
+
+
+class MemoryTimelineStore(TimelineStore):
+    """Per-process store, for development and single-worker deployments"""
+
+    def __init__(self, max_length=800):
+        super().__init__(max_length)
+        self._timelines = {}  # user_id -> ascending list of (created_at, post_id, author_id)
+        self._pull_authors = set()
+        self._lock = threading.Lock()
+
+    def exists(self, user_id):
+        return user_id in self._timelines
+
+    def build(self, user_id, entries):
+        with self._lock:
+            self._timelines[user_id] = sorted(entries)[-self.max_length:]
+
+    def push(self, follower_ids, created_at, post_id, author_id):
+        with self._lock:
+            for follower_id in follower_ids:
+                timeline = self._timelines.get(follower_id)
+                if timeline is not None:
+                    self._insert(timeline, (created_at, post_id, author_id))
+
+    def add_many(self, user_id, entries):
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is not None:
+                for entry in entries:
+                    self._insert(timeline, tuple(entry))
+
+    def _insert(self, timeline, entry):
+        if entry not in timeline:
+            insort(timeline, entry)
+            if len(timeline) > self.max_length:
+                del timeline[0]
+
+    def remove_author(self, user_id, author_id):
+        with self._lock:
+            timeline = self._timelines.get(user_id)
+            if timeline is not None:
+                timeline[:] = [entry for entry in timeline if entry[2] != author_id]
+
+    def page(self, user_id, before=None, limit=20):
+        with self._lock:
+            timeline = self._timelines.get(user_id, [])
+            result = []
+            for created_at, post_id, _ in reversed(timeline):
+                if before is not None and (created_at, post_id) >= tuple(before):
+                    continue
+                result.append((created_at, post_id))
+                if len(result) >= limit:
+                    break
+            return result
+
+    def add_pull_author(self, author_id):
+        self._pull_authors.add(author_id)
+
+    def pull_authors(self):
+        return set(self._pull_authors)
+
+
+class SQLTimelineStore(TimelineStore):
+    """Timelines kept in tables of the application database.
+
+    Writes go through `db.session` and are committed with the caller's
+    transaction. Entries are inserted ignoring duplicates: a timeline built
+    while a post is being fanned out may already contain it.
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, db, max_length=800):
+        super().__init__(max_length)
+        self.db = db
+        self.entries = db.Table(
+            'timeline_entry',
+            db.Column('user_id', db.Integer, primary_key=True),
+            db.Column('post_id', db.Integer, primary_key=True),
+            db.Column('author_id', db.Integer, nullable=False),
+            db.Column('created_at', db.DateTime, nullable=False),
+            db.Index('idx_timeline_entry_user_created', 'user_id', 'created_at', 'post_id'),
+            db.Index('idx_timeline_entry_user_author', 'user_id', 'author_id'),
+        )
+        self.state = db.Table(
+            'timeline_state',
+            db.Column('user_id', db.Integer, primary_key=True),
+            db.Column('built_at', db.DateTime, nullable=False),
+        )
+        self.pull = db.Table(
+            'timeline_pull_author',
+            db.Column('author_id', db.Integer, primary_key=True),
+        )
+
+    def exists(self, user_id):
+        query = self.db.select(self.state.c.user_id).where(self.state.c.user_id == user_id)
+        return self.db.session.execute(query).first() is not None
+
+    def build(self, user_id, entries):
+        session = self.db.session
+        session.execute(self.entries.delete().where(self.entries.c.user_id == user_id))
+        session.execute(self.state.delete().where(self.state.c.user_id == user_id))
+        rows = self._rows(user_id, sorted(entries)[-self.max_length:])
+        if rows:
+            insert_ignore(self.entries, rows, session)
+        insert_ignore(self.state, [{'user_id': user_id, 'built_at': datetime.utcnow()}], session)
+
+    def push(self, follower_ids, created_at, post_id, author_id):
+        follower_ids = list(follower_ids)
+        session = self.db.session
+        for start in range(0, len(follower_ids), self.CHUNK_SIZE):
+            chunk = follower_ids[start:start + self.CHUNK_SIZE]
+            built = session.execute(
+                self.db.select(self.state.c.user_id).where(self.state.c.user_id.in_(chunk))
+            ).scalars().all()
+            if built:
+                insert_ignore(self.entries, [
+                    {'user_id': user_id, 'post_id': post_id, 'author_id': author_id, 'created_at': created_at}
+                    for user_id in built
+                ], session)
+                self._trim(built)
+
+    def add_many(self, user_id, entries):
+        if not entries or not self.exists(user_id):
+            return
+        for start in range(0, len(entries), self.CHUNK_SIZE):
+            insert_ignore(self.entries, self._rows(user_id, entries[start:start + self.CHUNK_SIZE]), self.db.session)
+        self._trim([user_id])
+
+    def _trim(self, user_ids):
+        """Delete the entries of `user_ids` older than their max_length-th newest"""
+        entries = self.entries
+        newer = entries.alias('newer')
+        cutoff = self.db.select(newer.c.created_at).where(
+            newer.c.user_id == entries.c.user_id
+        ).order_by(
+            newer.c.created_at.desc(), newer.c.post_id.desc()
+        ).offset(self.max_length - 1).limit(1).correlate(entries).scalar_subquery()
+        self.db.session.execute(entries.delete().where(
+            entries.c.user_id.in_(user_ids),
+            entries.c.created_at < cutoff
+        ))
+
+    def _rows(self, user_id, entries):
+        return [
+            {'user_id': user_id, 'created_at': created_at, 'post_id': post_id, 'author_id': author_id}
+            for created_at, post_id, author_id in entries
+        ]
+
+    def remove_author(self, user_id, author_id):
+        self.db.session.execute(self.entries.delete().where(
+            self.entries.c.user_id == user_id,
+            self.entries.c.author_id == author_id
+        ))
+
+    def page(self, user_id, before=None, limit=20):
+        entries = self.entries
+        query = self.db.select(entries.c.created_at, entries.c.post_id).where(entries.c.user_id == user_id)
+        if before is not None:
+            query = query.where(self.db.tuple_(entries.c.created_at, entries.c.post_id) < self.db.tuple_(*before))
+        query = query.order_by(entries.c.created_at.desc(), entries.c.post_id.desc()).limit(limit)
+        return [tuple(row) for row in self.db.session.execute(query)]
+
+    def add_pull_author(self, author_id):
+        insert_ignore(self.pull, [{'author_id': author_id}], self.db.session)
+
+    def pull_authors(self):
+        return set(self.db.session.execute(self.db.select(self.pull.c.author_id)).scalars())
+
+
+class RedisTimelineStore(TimelineStore):
+    """Timelines as Redis sorted sets (works with any Redis-compatible server).
+
+    Scores are integer microseconds since the epoch; members are
+    "<post_id>:<author_id>".
+    """
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, client, max_length=800, prefix='timeline'):
+        super().__init__(max_length)
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, user_id):
+        return f'{self.prefix}:{user_id}'
+
+    @staticmethod
+    def _score(created_at):
+        return (created_at - EPOCH) // timedelta(microseconds=1)
+
+    @staticmethod
+    def _created_at(score):
+        return EPOCH + timedelta(microseconds=int(score))
+
+    def exists(self, user_id):
+        return bool(self.client.sismember(f'{self.prefix}:built', user_id))
+
+    def build(self, user_id, entries):
+        key = self._key(user_id)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        mapping = {f'{post_id}:{author_id}': self._score(created_at) for created_at, post_id, author_id in entries}
+        if mapping:
+            pipe.zadd(key, mapping)
+            pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+        pipe.sadd(f'{self.prefix}:built', user_id)
+        pipe.execute()
+
+    def push(self, follower_ids, created_at, post_id, author_id):
+        follower_ids = list(follower_ids)
+        member = {f'{post_id}:{author_id}': self._score(created_at)}
+        for start in range(0, len(follower_ids), self.CHUNK_SIZE):
+            chunk = follower_ids[start:start + self.CHUNK_SIZE]
+            built = self.client.smismember(f'{self.prefix}:built', chunk)
+            pipe = self.client.pipeline(transaction=False)
+            for follower_id, is_built in zip(chunk, built):
+                if is_built:
+                    key = self._key(follower_id)
+                    pipe.zadd(key, member)
+                    pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+            pipe.execute()
+
+    def add_many(self, user_id, entries):
+        if not entries or not self.exists(user_id):
+            return
+        key = self._key(user_id)
+        pipe = self.client.pipeline()
+        pipe.zadd(key, {f'{post_id}:{author_id}': self._score(created_at) for created_at, post_id, author_id in entries})
+        pipe.zremrangebyrank(key, 0, -self.max_length - 1)
+        pipe.execute()
+
+    def remove_author(self, user_id, author_id):
+        key = self._key(user_id)
+        suffix = f':{author_id}'
+        members = [m for m in self.client.zrange(key, 0, -1) if m.decode().endswith(suffix)]
+        if members:
+            self.client.zrem(key, *members)
+
+    def page(self, user_id, before=None, limit=20):
+        max_score = '+inf' if before is None else self._score(before[0])
+        # Over-fetch a little so entries tied with the cursor can be skipped
+        rows = self.client.zrevrangebyscore(self._key(user_id), max_score, '-inf', start=0, num=limit + 10, withscores=True)
+        result = []
+        for member, score in rows:
+            created_at = self._created_at(score)
+            post_id = int(member.decode().split(':', 1)[0])
+            if before is not None and (created_at, post_id) >= tuple(before):
+                continue
+            result.append((created_at, post_id))
+        result.sort(reverse=True)
+        return result[:limit]
+
+    def add_pull_author(self, author_id):
+        self.client.sadd(f'{self.prefix}:pull_authors', author_id)
+
+    def pull_authors(self):
+        return {int(author_id) for author_id in self.client.smembers(f'{self.prefix}:pull_authors')}
+
+
+def create_timeline_store(app, db):
+    """Build the store selected by TIMELINE_BACKEND ('sql', 'memory', 'redis' or 'none')"""
+    backend = app.config.get('TIMELINE_BACKEND', 'sql')
+    max_length = app.config.get('TIMELINE_MAX_LENGTH', 800)
+
+    if backend == 'none':
+        return None
+    if backend == 'memory':
+        return MemoryTimelineStore(max_length)
+    if backend == 'sql':
+        return SQLTimelineStore(db, max_length)
+    if backend == 'redis':
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('TIMELINE_BACKEND=redis requires the redis package (pip install redis)') from e
+        return RedisTimelineStore(redis.Redis.from_url(app.config['REDIS_URL']), max_length)
+    raise ValueError(f'Unknown TIMELINE_BACKEND: {backend}')
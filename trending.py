@@ -0,0 +1,180 @@
+"""
+Trending posts ranking for FemboyWorld.
+Keeps a rolling like score for every post created inside the trending
+window, updated incrementally by likes and rebuilt from the database by a
+background job, so trending pages read a ready ranking instead of running
+the JOIN/GROUP BY aggregate on every request.
+"""
+
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from background import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+
+class TrendingEngine:
+    """In-memory trending ranking, one per worker process.
+
+    `loader(cutoff)` must return (post_id, created_at, like_count) rows for
+    posts created at or after `cutoff`. Each worker only sees its own likes
+    incrementally; the periodic rebuild brings every worker back in line
+    with the database.
+    """
+
+    def __init__(self, app=None, loader=None):
+        self.app = None
+        self.loader = None
+        self.window = timedelta(days=7)
+        self._scores = {}  # post_id -> [created_at, score]
+        self.enabled = True
+        self._ranking = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._task = None
+
+        # Counters
+        self.rebuilds = 0
+        self.failed_rebuilds = 0
+        self.incremental_updates = 0
+        self.last_drift = 0  # posts whose incremental score disagreed with the rebuild
+
+        if app is not None and loader is not None:
+            self.init_app(app, loader)
+
+    def init_app(self, app, loader):
+        self.app = app
+        self.loader = loader
+        self.window = timedelta(days=app.config.get('TRENDING_WINDOW_DAYS', 7))
+        self.enabled = app.config.get('TRENDING_ENGINE_ENABLED', True)
+        interval = app.config.get('TRENDING_REFRESH_INTERVAL', 300)
+        self._task = PeriodicTask('trending-refresh', interval, self.refresh)
+
+    def cutoff(self):
+        return datetime.utcnow() - self.window
+
+    def is_warm(self):
+        return self._loaded_at is not None
+
+    def record_like(self, post_id, created_at, delta=1):
+        """Apply a like (+1) or unlike (-1) to the live ranking"""
+        if not self.is_warm() or created_at is None or created_at < self.cutoff():
+            return
+        with self._lock:
+            entry = self._scores.setdefault(post_id, [created_at, 0])
+            entry[1] = max(entry[1] + delta, 0)
+            if entry[1] == 0:
+                del self._scores[post_id]
+            self._ranking = None
+            self.incremental_updates += 1
+
+    def forget(self, post_id):
+        """Drop a post from the ranking (e.g. after it was deleted)"""
+        with self._lock:
+            if self._scores.pop(post_id, None) is not None:
+                self._ranking = None
+
+    def refresh(self):
+        """Rebuild all scores from the database"""
+        cutoff = self.cutoff()
+        try:
+            with self.app.app_context():
+                rows = self.loader(cutoff)
+                scores = {
+                    post_id: [created_at, count]
+                    for post_id, created_at, count in rows
+                    if count > 0
+                }
+        except Exception:
+            self.failed_rebuilds += 1
+            logger.exception('Failed to rebuild trending ranking')
+            return False
+
+        with self._lock:
+            if self._loaded_at is not None:
+                self.last_drift = sum(
+                    1 for post_id in set(scores) | set(self._scores)
+                    if scores.get(post_id, [None, 0])[1] != self._scores.get(post_id, [None, 0])[1]
+                )
+                if self.last_drift:
+                    logger.info('Trending rebuild corrected %d drifted scores', self.last_drift)
+            self._scores = scores
+            self._ranking = None
+            self._loaded_at = time.time()
+            self.rebuilds += 1
+        return True
+
+    def top(self, limit=20):
+        """Return up to `limit` trending post ids, or None if not ready"""
+        if not self.enabled:
+            return None
+        if not self.is_warm() and not self.refresh():
+            return None
+        self._task.ensure_started()
+
+        with self._lock:
+            if self._ranking is None or len(self._ranking) < limit <= len(self._scores):
+                self._expire()
+                self._ranking = [
+                    post_id for post_id, _ in heapq.nlargest(
+                        limit,
+                        self._scores.items(),
+                        key=lambda item: (item[1][1], item[1][0], item[0])
+                    )
+                ]
+            return self._ranking[:limit]
+
+    def scores(self, post_ids):
+        """Current scores for the given posts"""
+        with self._lock:
+            return {post_id: self._scores.get(post_id, [None, 0])[1] for post_id in post_ids}
+
+    def _expire(self):
+        cutoff = self.cutoff()
+        expired = [post_id for post_id, (created_at, _) in self._scores.items() if created_at < cutoff]
+        for post_id in expired:
+            del self._scores[post_id]
+
+    def check_consistency(self, limit=20):
+        """Compare the live ranking against a fresh database aggregate.
+
+        Ties can be ordered differently, so this compares scores rather than
+        positions: every ranked post must have its database score, and the
+        sequence of top scores must match.
+        """
+        ranked = self.top(limit) or []
+        live = self.scores(ranked)
+        with self.app.app_context():
+            rows = list(self.loader(self.cutoff()))
+        expected = {post_id: count for post_id, _, count in rows if count > 0}
+        expected_top = sorted(expected.values(), reverse=True)[:limit]
+
+        mismatches = {
+            post_id: {'live': live[post_id], 'database': expected.get(post_id, 0)}
+            for post_id in ranked
+            if live[post_id] != expected.get(post_id, 0)
+        }
+        return {
+            'consistent': not mismatches and [live[p] for p in ranked] == expected_top,
+            'ranked': len(ranked),
+            'mismatches': mismatches,
+            'expected_top_scores': expected_top,
+            'live_top_scores': [live[p] for p in ranked],
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'warm': self.is_warm(),
+                'tracked_posts': len(self._scores),
+                'age_seconds': round(time.time() - self._loaded_at, 1) if self._loaded_at else None,
+                'rebuilds': self.rebuilds,
+                'failed_rebuilds': self.failed_rebuilds,
+                'incremental_updates': self.incremental_updates,
+                'last_drift': self.last_drift,
+            }
@@ -0,0 +1,201 @@
+"""
+Resumable chunked uploads for FemboyWorld, following the tus 1.0 protocol
+(core plus the creation, checksum, termination and expiration extensions).
+Each partial upload is a `<id>.part` file with a `<id>.json` sidecar in
+CHUNKED_UPLOAD_FOLDER. Chunks are streamed to disk in small pieces, so a
+worker's memory use does not depend on the file or chunk size.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import secrets
+import time
+from contextlib import contextmanager
+
+TUS_VERSION = '1.0.0'
+CHECKSUM_ALGORITHMS = ('sha256', 'sha1', 'md5')
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """A request the client has to fix; carries the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_metadata(header):
+    """Decode an Upload-Metadata header ("key base64value, key2 base64value2")"""
+    metadata = {}
+    for pair in (header or '').split(','):
+        pair = pair.strip()
+        if not pair:
+            continue
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode() if value else ''
+        except (ValueError, UnicodeDecodeError):
+            raise UploadError(f'Invalid Upload-Metadata value for {key!r}')
+    return metadata
+
+
+def parse_checksum(header):
+    """Split an Upload-Checksum header into (algorithm, digest bytes)"""
+    if not header:
+        return None
+    algorithm, _, value = header.strip().partition(' ')
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError(f'Unsupported checksum algorithm {algorithm!r}')
+    try:
+        return algorithm, base64.b64decode(value, validate=True)
+    except ValueError:
+        raise UploadError('Invalid Upload-Checksum value')
+
+
+class ChunkedUploadStore:
+    """Partial uploads on disk, shared by every worker through the filesystem"""
+
+    LOCK_TIMEOUT = 300  # seconds before a lock left by a crashed worker is broken
+
+    def __init__(self, directory, expiry=86400):
+        self.directory = directory
+        self.expiry = expiry
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, upload_id, suffix):
+        if not upload_id.isalnum():
+            raise UploadError('Upload not found', 404)
+        return os.path.join(self.directory, f'{upload_id}.{suffix}')
+
+    def create(self, length, info):
+        """Start an upload of `length` bytes; `info` is stored alongside it"""
+        upload_id = secrets.token_hex(16)
+        open(self._path(upload_id, 'part'), 'wb').close()
+        self._save(upload_id, dict(info, length=length, offset=0, created_at=time.time()))
+        return upload_id
+
+    def get(self, upload_id):
+        """The upload's info (including 'length' and 'offset'), or UploadError 404"""
+        try:
+            with open(self._path(upload_id, 'json')) as f:
+                info = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Upload not found', 404)
+        info['id'] = upload_id
+        info['expires_at'] = info.get('updated_at', info['created_at']) + self.expiry
+        return info
+
+    def _save(self, upload_id, info):
+        info = {key: value for key, value in info.items() if key not in ('id', 'expires_at')}
+        info['updated_at'] = time.time()
+        tmp = self._path(upload_id, 'json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+        os.replace(tmp, self._path(upload_id, 'json'))
+
+    def _lock(self, upload_id):
+        path = self._path(upload_id, 'lock')
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stale = time.time() - os.path.getmtime(path) > self.LOCK_TIMEOUT
+            except FileNotFoundError:
+                stale = True
+            if not stale:
+                raise UploadError('Another request is writing to this upload', 423)
+            try:
+                os.unlink(path)
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except (FileExistsError, FileNotFoundError):
+                # Another request broke the stale lock first
+                raise UploadError('Another request is writing to this upload', 423)
+        os.close(fd)
+        return path
+
+    @contextmanager
+    def locked(self, upload_id):
+        """Hold the upload's lock (UploadError 423 if another request has it)"""
+        lock = self._lock(upload_id)
+        try:
+            yield
+        finally:
+            try:
+                os.unlink(lock)
+            except FileNotFoundError:
+                pass  # deleted along with the upload
+
+    def append(self, upload_id, offset, stream, checksum=None):
+        """Write a chunk at `offset`, streaming from `stream`.
+
+        The chunk is discarded (and 460 raised) if it doesn't match the
+        Upload-Checksum. Returns (info, completed); `completed` is True only
+        for the request that wrote the final byte.
+        """
+        self.get(upload_id)
+        with self.locked(upload_id):
+            info = self.get(upload_id)  # re-read now that we hold the lock
+            if offset != info['offset']:
+                raise UploadError(f'Upload-Offset {offset} does not match the current offset {info["offset"]}', 409)
+
+            digest = hashlib.new(checksum[0]) if checksum else None
+            remaining = info['length'] - offset
+            written = 0
+            with open(self._path(upload_id, 'part'), 'r+b') as f:
+                f.seek(offset)
+                while True:
+                    data = stream.read(READ_SIZE)
+                    if not data:
+                        break
+                    written += len(data)
+                    if written > remaining:
+                        f.truncate(offset)
+                        raise UploadError('Chunk goes past Upload-Length', 413)
+                    f.write(data)
+                    if digest is not None:
+                        digest.update(data)
+
+                if digest is not None and digest.digest() != checksum[1]:
+                    f.truncate(offset)
+                    raise UploadError('Checksum mismatch', 460)
+                f.truncate(offset + written)
+
+            info['offset'] = offset + written
+            self._save(upload_id, info)
+            return info, offset < info['length'] == info['offset']
+
+    def path(self, upload_id):
+        """Location of the upload's data on disk"""
+        return self._path(upload_id, 'part')
+
+    def delete(self, upload_id):
+        for suffix in ('part', 'json', 'lock'):
+            try:
+                os.unlink(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def cleanup(self):
+        """Remove uploads that have not received data within the expiry; returns the count"""
+        cutoff = time.time() - self.expiry
+        removed = 0
+        for name in os.listdir(self.directory):
+            upload_id, _, suffix = name.partition('.')
+            path = os.path.join(self.directory, name)
+            try:
+                if suffix == 'json':
+                    expired = self.get(upload_id)['expires_at'] < time.time()
+                elif suffix == 'part':
+                    # Data without a sidecar (crash between writes)
+                    expired = not os.path.exists(self._path(upload_id, 'json')) and os.path.getmtime(path) < cutoff
+                else:
+                    continue
+            except (UploadError, FileNotFoundError, ValueError):
+                continue
+            if expired:
+                self.delete(upload_id)
+                removed += 1
+        return removed
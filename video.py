@@ -0,0 +1,182 @@
+"""
+Video metadata and poster frames for FemboyWorld uploads.
+Runs in a MediaProcessor pool (see imaging.py). ffprobe/ffmpeg are used
+when installed; otherwise MP4/MOV metadata is read with a small ISO base
+media box parser and no poster is produced. The box parser is also the
+fallback for files ffprobe rejects. The results land on
+Post.duration / width / height / video_codec and Post.variants['poster'];
+whatever could be read is stored, so a bad file is still marked processed.
+"""
+
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+
+from imaging import VARIANT_DIR
+
+logger = logging.getLogger(__name__)
+
+FFPROBE = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+FFMPEG = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+TIMEOUT = 60  # seconds per ffmpeg/ffprobe call
+POSTER_WIDTH = 1080
+
+# Boxes that only contain other boxes, on the path to the ones we read
+CONTAINERS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+
+def _boxes(f, start, end):
+    """Yield (type, payload offset, payload end) for the boxes in [start, end)"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset  # box runs to the end of its parent
+        if size < header:
+            return  # corrupt
+        yield box_type, offset + header, min(offset + size, end)
+        offset += size
+
+
+def _read_mvhd(f, start):
+    f.seek(start)
+    version = f.read(1)[0]
+    f.seek(start + 4)
+    if version == 1:
+        _, _, timescale, duration = struct.unpack('>QQIQ', f.read(28))
+    else:
+        _, _, timescale, duration = struct.unpack('>IIII', f.read(16))
+    return duration / timescale if timescale else None
+
+
+def _read_tkhd(f, start):
+    f.seek(start)
+    version = f.read(1)[0]
+    # width and height are the last 8 bytes, 16.16 fixed point
+    f.seek(start + (88 if version == 1 else 76))
+    width, height = struct.unpack('>II', f.read(8))
+    return width >> 16, height >> 16
+
+
+def _read_track(f, start, end):
+    """(handler type, codec fourcc, (width, height)) of one trak box"""
+    handler = codec = size = None
+    stack = [(start, end)]
+    while stack:
+        box_start, box_end = stack.pop()
+        for box_type, payload, payload_end in _boxes(f, box_start, box_end):
+            if box_type == b'tkhd':
+                size = _read_tkhd(f, payload)
+            elif box_type == b'hdlr':
+                f.seek(payload + 8)  # version/flags, pre_defined
+                handler = f.read(4)
+            elif box_type == b'stsd':
+                f.seek(payload + 8)  # version/flags, entry count
+                codec = f.read(8)[4:8]  # first sample entry: size, format
+            elif box_type in CONTAINERS:
+                stack.append((payload, payload_end))
+    return handler, codec, size
+
+
+def probe_mp4(path):
+    """Duration, size and codec of an MP4/MOV file without decoding it.
+
+    Only box headers and the moov box are read, so this is cheap even for
+    multi-gigabyte files. Returns None for files that aren't ISO media.
+    """
+    result = {}
+    with open(path, 'rb') as f:
+        end = os.fstat(f.fileno()).st_size
+        found_moov = False
+        for box_type, payload, payload_end in _boxes(f, 0, end):
+            if box_type != b'moov':
+                continue
+            found_moov = True
+            for child, child_start, child_end in _boxes(f, payload, payload_end):
+                if child == b'mvhd':
+                    result['duration'] = _read_mvhd(f, child_start)
+                elif child == b'trak':
+                    handler, codec, size = _read_track(f, child_start, child_end)
+                    if handler == b'vide' and 'video_codec' not in result:
+                        result['video_codec'] = codec.decode('latin-1').strip() if codec else None
+                        if size and all(size):
+                            result['width'], result['height'] = size
+        if not found_moov:
+            return None
+    return result
+
+
+def probe_ffprobe(path):
+    """Duration, size and codec via ffprobe, or None if it isn't installed"""
+    if shutil.which(FFPROBE) is None:
+        return None
+    output = subprocess.run(
+        [FFPROBE, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+        capture_output=True, check=True, timeout=TIMEOUT
+    ).stdout
+    info = json.loads(output)
+    result = {}
+    if info.get('format', {}).get('duration'):
+        result['duration'] = float(info['format']['duration'])
+    for stream in info.get('streams', []):
+        if stream.get('codec_type') == 'video':
+            result['video_codec'] = stream.get('codec_name')
+            result['width'] = stream.get('width')
+            result['height'] = stream.get('height')
+            break
+    return result
+
+
+def extract_poster(source, target, at=0.0):
+    """Write a JPEG frame from `at` seconds in; False if ffmpeg isn't installed"""
+    if shutil.which(FFMPEG) is None:
+        return False
+    subprocess.run(
+        [FFMPEG, '-v', 'error', '-y', '-ss', f'{at:.2f}', '-i', source, '-frames:v', '1',
+         '-vf', f"scale='min({POSTER_WIDTH},iw)':-2", '-q:v', '3', target],
+        capture_output=True, check=True, timeout=TIMEOUT
+    )
+    return os.path.exists(target)
+
+
+def process_video(upload_folder, media_path):
+    """Probe one uploaded video and grab its poster frame; runs in a pool worker"""
+    source = os.path.join(upload_folder, *media_path.split('/'))
+    metadata = None
+    try:
+        metadata = probe_ffprobe(source)
+    except (OSError, subprocess.SubprocessError, ValueError):
+        logger.warning('ffprobe could not read %s', media_path, exc_info=True)
+    if metadata is None and media_path.lower().rsplit('.', 1)[-1] in ('mp4', 'mov'):
+        try:
+            metadata = probe_mp4(source)
+        except (OSError, struct.error, IndexError, ValueError):
+            logger.warning('Could not parse the MP4 boxes of %s', media_path, exc_info=True)
+    metadata = metadata or {}
+
+    variants = {}
+    stem = os.path.splitext(os.path.basename(media_path))[0]
+    poster = f'{VARIANT_DIR}/{stem}_poster.jpg'
+    os.makedirs(os.path.join(upload_folder, VARIANT_DIR), exist_ok=True)
+    duration = metadata.get('duration') or 0
+    try:
+        if extract_poster(source, os.path.join(upload_folder, poster), at=min(1.0, duration / 2)):
+            variants['poster'] = poster
+    except (OSError, subprocess.SubprocessError):
+        logger.warning('ffmpeg could not extract a poster from %s', media_path, exc_info=True)
+
+    return {
+        'duration': metadata.get('duration'),
+        'width': metadata.get('width'),
+        'height': metadata.get('height'),
+        'video_codec': metadata.get('video_codec'),
+        'variants': variants,  # {} still marks the post as processed
+    }
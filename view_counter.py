@@ -0,0 +1,115 @@
+"""
+Batched post view counting for FemboyWorld.
+Views are collected in memory per worker and written in one transaction
+of `view_count = view_count + n` updates, so a page view never waits on
+the database write lock.
+"""
+
+import atexit
+import logging
+import threading
+
+from sqlalchemy import text
+
+from background import PeriodicTask
+
+logger = logging.getLogger(__name__)
+
+UPDATE_VIEW_COUNT = text(
+    "UPDATE post SET view_count = COALESCE(view_count, 0) + :n WHERE id = :post_id"
+)
+
+
+class ViewCounter:
+    """Thread-safe aggregator for post view increments"""
+
+    def __init__(self, app=None, db=None):
+        self.app = None
+        self.db = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self.enabled = True  # views are dropped while False (e.g. during the index advisor's replay)
+
+        # Counters
+        self.increments = 0          # views recorded by increment()
+        self.flushed_increments = 0  # views written to the database
+        self.rows_written = 0        # UPDATE statements issued
+        self.flushes = 0
+        self.failed_flushes = 0
+
+        if app is not None and db is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        self.app = app
+        self.db = db
+        interval = app.config.get('VIEW_COUNT_FLUSH_INTERVAL', 5)
+        self._task = PeriodicTask('view-count-flusher', interval, self.flush)
+        atexit.register(self.shutdown)
+
+    def increment(self, post_id, n=1):
+        """Record `n` views of a post"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending[post_id] = self._pending.get(post_id, 0) + n
+            self.increments += n
+
+        if self._task.interval <= 0:
+            # Write-through mode (tests, or batching disabled)
+            self.flush()
+        else:
+            self._task.ensure_started()
+
+    def pending(self, post_id=None):
+        """Views not yet written, for one post or in total"""
+        with self._lock:
+            if post_id is None:
+                return sum(self._pending.values())
+            return self._pending.get(post_id, 0)
+
+    def flush(self):
+        """Write all pending increments in a single transaction"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+
+        params = [{'post_id': post_id, 'n': n} for post_id, n in batch.items()]
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    conn.execute(UPDATE_VIEW_COUNT, params)
+        except Exception:
+            # Put the views back so the next flush retries them
+            with self._lock:
+                for post_id, n in batch.items():
+                    self._pending[post_id] = self._pending.get(post_id, 0) + n
+                self.failed_flushes += 1
+            logger.exception('Failed to flush %d view counts', len(batch))
+            return 0
+
+        with self._lock:
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.flushed_increments += sum(batch.values())
+        return len(batch)
+
+    def shutdown(self):
+        """Stop the flusher and write whatever is left"""
+        if self._task is not None:
+            self._task.stop()
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'increments': self.increments,
+                'pending': sum(self._pending.values()),
+                'flushed_increments': self.flushed_increments,
+                'rows_written': self.rows_written,
+                'merged_increments': self.flushed_increments - self.rows_written,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+            }